@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import tempfile
+
+from wfb_emu import LINKS, LinkProfile, start_links
+from wfb_ft import Command, FtpClient, FtpServer
+
+"""
+wfb_ft benchmark without radios: an air FtpServer sends a random file to a
+ground FtpClient through wfb_emu links (ft ports 6555-6558) for a matrix
+of link conditions, prints goodput and chunk retransmission ratio
+
+python3 ft_bench.py --size 2048 --condition loss=0.05 --condition 'loss=0.2,fec=8/12'
+"""
+
+MATRIX = [
+    '',
+    'loss=0.01',
+    'loss=0.05',
+    'loss=0.1',
+    'loss=0.01,burst_p=0.01,burst_r=0.25',
+    'delay=20,jitter=5',
+    'reorder=0.05',
+    'duplicate=0.05',
+    'rate=256',
+    'loss=0.2,fec=8/12',
+    'loss=0.05,delay=10,jitter=3,rate=256,fec=8/12',
+]
+
+AIR_IN, AIR_OUT = LINKS[1][1], LINKS[0][0]
+GROUND_IN, GROUND_OUT = LINKS[0][1], LINKS[1][0]
+
+
+def close_node(node):
+    for proto in node.in_proto, node.out_proto:
+        if getattr(proto, 'transport', None) is not None:
+            proto.transport.close()
+
+
+async def run_condition(profile, name, args):
+    endpoints = await start_links(profile, LINKS[:2], args.seed)
+    downlink = endpoints[0][1]
+    server = FtpServer(AIR_IN, AIR_OUT, args.root_dir, max_rate=args.max_rate * 1024,
+                       rate_control=not args.fixed_rate, batch_io=args.batch_io)
+    server_task = asyncio.create_task(server.start())
+    client = FtpClient(GROUND_IN, GROUND_OUT, batch_io=args.batch_io)
+    fec_k, fec_m = (int(v) for v in args.fec.split('/'))
+    try:
+        transfer_time = await asyncio.wait_for(client.get_file(name, fec_k=fec_k, fec_m=fec_m, resume=False),
+                                               args.timeout)
+    except (asyncio.TimeoutError, ValueError) as e:
+        transfer_time = None
+        logging.warning('%s: %s', profile, e or 'timeout')
+    finally:
+        server_task.cancel()
+        server.scheduler_task.cancel()
+        server.compress_pool.shutdown(wait=False)
+        close_node(server)
+        close_node(client)
+        for transport, _ in endpoints:
+            transport.close()
+    chunks = math.ceil(args.size * 1024 / server.link.chunk_size())
+    return transfer_time, downlink.kinds[Command.SEND_CHUNK] / max(chunks, 1) - 1, downlink.stats
+
+
+def main(args):
+    root_dir = tempfile.mkdtemp(prefix='ft_bench_root_')
+    download_dir = tempfile.mkdtemp(prefix='ft_bench_dl_')
+    name = 'bench.bin'
+    data = os.urandom(args.size * 1024)
+    with open(os.path.join(root_dir, name), 'wb') as f:
+        f.write(data)
+    args.root_dir = root_dir
+    os.chdir(download_dir)
+
+    print('{:<56} {:>8} {:>12} {:>9} {:>8} {:>8}'.format(
+        'condition', 'time', 'goodput', 'retrans', 'lost', 'file'))
+    for condition in args.condition or MATRIX:
+        profile = LinkProfile.parse(condition)
+        transfer_time, retransmissions, stats = asyncio.run(run_condition(profile, name, args))
+        if transfer_time is None:
+            print('{:<56} {:>8}'.format(str(profile), 'failed'))
+            continue
+        with open(name, 'rb') as f:
+            ok = hashlib.blake2b(f.read()).digest() == hashlib.blake2b(data).digest()
+        os.remove(name)
+        print('{:<56} {:>7.2f}s {:>8.1f}kB/s {:>8.1%} {:>8} {:>8}'.format(
+            str(profile), transfer_time, args.size / transfer_time, retransmissions, stats['lost'],
+            'ok' if ok else 'BROKEN'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WFB FT benchmark over emulated lossy links')
+
+    parser.add_argument('--size', type=int, default=1024, help='Test file size kB')
+    parser.add_argument('--condition', action='append', help="Link condition, e.g. 'loss=0.05,delay=20,fec=8/12', repeatable (default: built in matrix)")
+    parser.add_argument('--fec', type=str, default='0/0', help='App level FEC k/m of the transfers')
+    parser.add_argument('--max-rate', type=int, default=FtpServer.MAX_RATE // 1024, help='Server max send rate kB/s')
+    parser.add_argument('--fixed-rate', action='store_true', help='Pace at max rate, no congestion control')
+    parser.add_argument('--batch-io', action='store_true', help='Batch UDP syscalls of the nodes with sendmmsg/recvmmsg')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds before a transfer counts as failed')
+    parser.add_argument('--seed', type=int, default=1, help='Emulator random seed')
+    parser.add_argument('--log-level', help='Log level', default='WARNING')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)-8s %(name)s: %(message)s")
+    main(args)
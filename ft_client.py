@@ -1,23 +1,118 @@
 import argparse
 import asyncio
+import json
 import logging
+import time
 
-from wfb_ft import FtpClient
+from ft_daemon import SOCKET_PATH, FtDaemon
+from wfb_ft import Codec, FtpClient, RadioLink, ResumeFileMessage
+
+
+async def daemon_get(socket_path, name, request):
+    """
+    Queue `name` on the ft_daemon and print its progress, True when downloaded
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(json.dumps(dict(request, cmd='get', name=name, wait=True)).encode() + b'\n')
+    status = None
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            status = json.loads(line)
+            if 'size' in status:
+                print('{} #{} {}: {} of {} bytes, {:.1f} kB/s'.format(
+                    name, status.get('id'), status['status'], status['bytes'], status['size'], status['goodput'] / 1024))
+            else:
+                print('{} #{} {}{}'.format(name, status.get('id'), status['status'],
+                                           ': ' + status['error'] if 'error' in status else ''))
+            if status['status'] not in ('queued', 'running'):
+                break
+    finally:
+        writer.close()
+    return status is not None and status['status'] == 'done'
+
+
+async def get_files(client, names, **kwargs):
+    """
+    Download the files one after another with one node, False when some failed
+    """
+    ok = True
+    for i, name in enumerate(names):
+        linger = FtpClient.LINGER if i == len(names) - 1 else 0
+        try:
+            await client.get_file(name, linger=linger, **kwargs)
+        except (FileNotFoundError, ValueError, TimeoutError) as e:
+            logging.error("%s", e)
+            ok = False
+    return ok
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='WFB FT client - file download')
 
-    parser.add_argument('--inport', type=int, required=True, help='WFB UDP input port')
-    parser.add_argument('--outport', type=int, required=True, help='WFB UDP out port')
+    parser.add_argument('--inport', type=int, help='WFB UDP input port')
+    parser.add_argument('--outport', type=int, help='WFB UDP out port')
     parser.add_argument('--log-level', help='Log level', default='INFO')
-    parser.add_argument('filename', help='file to download')
+    parser.add_argument('--no-resume', action='store_true', help='Ignore partial download, fetch the whole file')
+    parser.add_argument('--delta', action='store_true', help='Update an existing local copy, fetch only changed blocks')
+    parser.add_argument('--fec', type=str, default='0/0', help='App level FEC k/m - m parity chunks per k data chunks, e.g. 8/1 (off by default)')
+    parser.add_argument('--compress', choices=sorted(Codec.names), default='none', help='Per chunk compression codec')
+    parser.add_argument('--priority', type=int, default=0, help='Transfer priority 0-255, higher is sent first')
+    parser.add_argument('--weight', type=int, default=1, help='Link share 1-255 against transfers of equal priority')
+    parser.add_argument('--list', action='store_true', help='List server files instead of downloading')
+    parser.add_argument('--hashes', action='store_true', help='Show file hashes in the list')
+    parser.add_argument('--receive', action='store_true', help='Save files the server multicasts instead of downloading')
+    parser.add_argument('--mtu', type=int, default=RadioLink.MTU, help='Uplink radio MTU, requests are sized to fit it')
+    parser.add_argument('--node-id', type=int, default=1, help='Ground station id 1-65535, unique among multicast receivers')
+    parser.add_argument('--stats-port', type=int, help='Local UDP port answering with transfer metrics JSON')
+    parser.add_argument('--batch-io', action='store_true', help='Batch UDP syscalls with sendmmsg/recvmmsg (Linux)')
+    parser.add_argument('--daemon', nargs='?', const=SOCKET_PATH,
+                        help='Queue the downloads on ft_daemon listening on this socket (default {})'.format(SOCKET_PATH))
+    parser.add_argument('filenames', nargs='*', help='files to download')
 
     args = parser.parse_args()
+    if not (args.list or args.receive) and not args.filenames:
+        parser.error('filename is required')
+    if not args.daemon and (args.inport is None or args.outport is None):
+        parser.error('--inport and --outport are required without --daemon')
+    if not 1 <= args.node_id <= 65535:
+        parser.error('--node-id must be 1-65535')
+    link = RadioLink(args.mtu)
+    if link.max_ranges(ResumeFileMessage) < 1 or link.max_signatures() < 1:
+        parser.error('--mtu {} is too small for requests'.format(args.mtu))
+    try:
+        options = FtDaemon.parse_options(dict(fec=args.fec, compress=args.compress, priority=args.priority,
+                                              weight=args.weight))
+    except ValueError as e:
+        parser.error(str(e))
     logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)-8s %(name)s: %(message)s")
     
-    client = FtpClient(args.inport, args.outport)
+    client = FtpClient(args.inport, args.outport, node_id=args.node_id, stats_port=args.stats_port,
+                       batch_io=args.batch_io, link=link)
     # loop = asyncio.get_event_loop()
     # asyncio.create_task(client.start())
 
-    asyncio.run(client.get_file(args.filename))
+    if args.list:
+        for name, size, mtime, digest in asyncio.run(client.get_list(hashes=args.hashes)):
+            print('{:>12} {} {}{}'.format(size, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime)), name,
+                                          ' ' + digest.hex() if digest else ''))
+        parser.exit()
+
+    if args.receive:
+        asyncio.run(client.receive_files())
+        parser.exit()
+
+    if args.daemon:
+        request = dict(fec=args.fec, compress=args.compress, resume=not args.no_resume, delta=args.delta,
+                       priority=args.priority, weight=args.weight)
+
+        async def submit_all():
+            return await asyncio.gather(*(daemon_get(args.daemon, name, request) for name in args.filenames))
+
+        parser.exit(0 if all(asyncio.run(submit_all())) else 1)
+
+    options.update(resume=not args.no_resume, delta=args.delta)
+    ok = asyncio.run(get_files(client, args.filenames, **options))
+    parser.exit(0 if ok else 1)
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import time
+
+from wfb_ft import Codec, FtpClient
+
+"""
+Long running FT client: owns the wfb ports and downloads the files queued
+over a Unix socket, several at once so one file's request handshake
+overlaps the tail of the previous transfer. One JSON object per line:
+
+{"cmd": "get", "name": "photo.jpg", "fec": "8/1", "compress": "zstd", "priority": 0, "weight": 1, "wait": true}
+{"cmd": "status"}
+{"cmd": "cancel", "id": 3}
+
+get answers {"id": ..., "status": "queued"}, with "wait" it then reports
+progress every PROGRESS_INTERVAL and ends with the job done or failed.
+
+python3 ft_daemon.py --inport=6556 --outport=6557 --dir=/home/pi/ftdownload
+python3 ft_client.py --daemon=/tmp/wfb_ft.sock photo.jpg log.bin
+"""
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = '/tmp/wfb_ft.sock'
+
+
+class Job:
+    """
+    One queued download
+    """
+
+    def __init__(self, job_id, name, session_id, options):
+        self.id = job_id
+        self.name = name
+        self.session_id = session_id
+        self.options = options
+        self.status = 'queued'
+        self.error = None
+        self.transfer_time = None
+        self.queued = time.monotonic()
+        self.task = None
+        self.done = asyncio.Event()
+
+    def snapshot(self, client):
+        info = dict(id=self.id, name=self.name, status=self.status)
+        stats = client.transfer_stats.get(self.session_id)
+        if stats is not None:
+            info.update(bytes=stats.bytes, size=stats.size, goodput=round(stats.goodput))
+        if self.transfer_time is not None:
+            info['time'] = round(self.transfer_time, 3)
+        if self.error is not None:
+            info['error'] = self.error
+        return info
+
+
+class FtDaemon:
+
+    PARALLEL = 2
+    FINISHED_KEPT = 64
+    PROGRESS_INTERVAL = 1.0
+    JOB_TIMEOUT = 3600  # seconds a download may take, 0 - no limit
+
+    def __init__(self, client, socket_path=SOCKET_PATH, parallel=PARALLEL, job_timeout=JOB_TIMEOUT):
+        self.client = client
+        self.socket_path = socket_path
+        self.parallel = parallel
+        self.job_timeout = job_timeout
+        self.queue = asyncio.PriorityQueue()  # (-priority, job id), first come first served within a priority
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.job_ids = itertools.count(1)
+
+    async def run(self):
+        await self.client.listen()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle_connection, self.socket_path)
+        logger.info("FT daemon listening on %s, %s parallel downloads", self.socket_path, self.parallel)
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.parallel)]
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    @staticmethod
+    def parse_options(request):
+        """
+        get_file keyword arguments of a get request, ValueError for bad values
+        """
+        def byte_value(name, default, low=0):
+            value = request.get(name, default)
+            if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= 255:
+                raise ValueError('{} must be an integer {}-255'.format(name, low))
+            return value
+
+        fec = request.get('fec', '0/0')
+        parts = fec.split('/') if isinstance(fec, str) else []
+        if len(parts) != 2 or not all(part.isdigit() and int(part) <= 255 for part in parts):
+            raise ValueError('fec must be k/m with 0-255 values, got {}'.format(fec))
+        compress = request.get('compress', 'none')
+        if compress not in Codec.names:
+            raise ValueError('Unknown codec {}'.format(compress))
+        return dict(fec_k=int(parts[0]), fec_m=int(parts[1]), codec=Codec.names[compress],
+                    resume=bool(request.get('resume', True)), delta=bool(request.get('delta', False)),
+                    priority=byte_value('priority', 0), weight=byte_value('weight', 1, low=1))
+
+    def submit(self, name, options):
+        job = Job(next(self.job_ids), name, self.client.next_session(), options)
+        self.jobs[job.id] = job
+        self.queue.put_nowait((-options['priority'], job.id))
+        logger.info("Job %s queued: %s", job.id, name)
+        return job
+
+    async def worker(self):
+        while True:
+            _, job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            if job is None or job.status != 'queued':
+                continue
+            job.status = 'running'
+            job.task = asyncio.create_task(self.download(job))
+            try:
+                await job.task
+            except asyncio.CancelledError:
+                if not job.task.cancelled():
+                    raise
+                job.status = 'cancelled'
+            self.finish(job)
+
+    async def download(self, job):
+        try:
+            job.transfer_time = await asyncio.wait_for(
+                self.client.get_file(job.name, session_id=job.session_id, linger=0, **job.options),
+                self.job_timeout or None)
+            job.status = 'done'
+        except asyncio.TimeoutError:
+            logger.error("Job %s %s timed out after %s s", job.id, job.name, self.job_timeout)
+            job.status = 'failed'
+            job.error = 'timed out after {} s'.format(self.job_timeout)
+        except Exception as e:
+            # a failed job must not take the worker down with it
+            logger.error("Job %s %s failed: %r", job.id, job.name, e)
+            job.status = 'failed'
+            job.error = str(e) or type(e).__name__
+
+    def finish(self, job):
+        job.done.set()
+        self.finished.append(job.id)
+        while len(self.finished) > self.FINISHED_KEPT:
+            self.jobs.pop(self.finished.popleft(), None)
+        logger.info("Job %s %s: %s", job.id, job.name, job.status)
+
+    def cancel(self, job):
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            self.finish(job)
+        elif job.status == 'running':
+            job.task.cancel()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    await self.handle_request(request, writer)
+                except (ValueError, KeyError, TypeError) as e:
+                    self.reply(writer, {'status': 'error', 'error': str(e)})
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, request, writer):
+        cmd = request['cmd']
+        if cmd == 'get':
+            name = request['name']
+            if not isinstance(name, str) or not name:
+                raise ValueError('name must be a file name')
+            job = self.submit(name, self.parse_options(request))
+            self.reply(writer, job.snapshot(self.client))
+            if request.get('wait'):
+                await self.report(job, writer)
+        elif cmd == 'status':
+            self.reply(writer, {'jobs': [job.snapshot(self.client) for job in self.jobs.values()]})
+        elif cmd == 'cancel':
+            job = self.jobs[request['id']]
+            self.cancel(job)
+            self.reply(writer, job.snapshot(self.client))
+        else:
+            raise ValueError('Unknown command {}'.format(cmd))
+
+    async def report(self, job, writer):
+        while not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.done.wait(), self.PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                self.reply(writer, job.snapshot(self.client))
+                await writer.drain()
+        self.reply(writer, job.snapshot(self.client))
+
+    @staticmethod
+    def reply(writer, data):
+        writer.write(json.dumps(data).encode() + b'\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WFB FT client daemon - queued downloads')
+
+    parser.add_argument('--inport', type=int, required=True, help='WFB UDP input port')
+    parser.add_argument('--outport', type=int, required=True, help='WFB UDP out port')
+    parser.add_argument('--socket', type=str, default=SOCKET_PATH, help='Unix socket accepting jobs')
+    parser.add_argument('--dir', type=str, default='.', help='Download directory')
+    parser.add_argument('--parallel', type=int, default=FtDaemon.PARALLEL, help='Downloads running at once')
+    parser.add_argument('--job-timeout', type=float, default=FtDaemon.JOB_TIMEOUT, help='Seconds before a download fails, 0 - no limit')
+    parser.add_argument('--node-id', type=int, default=1, help='Ground station id 1-65535, unique among multicast receivers')
+    parser.add_argument('--stats-port', type=int, help='Local UDP port answering with transfer metrics JSON')
+    parser.add_argument('--batch-io', action='store_true', help='Batch UDP syscalls with sendmmsg/recvmmsg (Linux)')
+    parser.add_argument('--log-level', help='Log level', default='INFO')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)-8s %(name)s: %(message)s")
+
+    os.chdir(args.dir)
+    client = FtpClient(args.inport, args.outport, node_id=args.node_id, stats_port=args.stats_port,
+                       batch_io=args.batch_io)
+    asyncio.run(FtDaemon(client, args.socket, args.parallel, args.job_timeout).run())
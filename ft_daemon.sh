@@ -0,0 +1,3 @@
+#! /bin/bash
+
+python3 /home/pi/wfb_stuff/ft_daemon.py --inport=6556 --outport=6557 --dir=/home/pi/ftdownload
@@ -1,2 +1,5 @@
-python3 /home/pi/wfb_stuff/ft_client.py --inport=6556 --outport=6557 $1
-
+if [ -S /tmp/wfb_ft.sock ]; then
+    python3 /home/pi/wfb_stuff/ft_client.py --daemon=/tmp/wfb_ft.sock "$@"
+else
+    python3 /home/pi/wfb_stuff/ft_client.py --inport=6556 --outport=6557 "$@"
+fi
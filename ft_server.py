@@ -3,7 +3,7 @@ import argparse
 import asyncio
 import logging
 
-from wfb_ft import FtpServer
+from wfb_ft import ChunkCache, Codec, FtpServer, GetListMessage, ListPageMessage, RadioLink
 
 
 if __name__ == '__main__':
@@ -13,10 +13,56 @@ if __name__ == '__main__':
     parser.add_argument('--outport', type=int, required=True, help='WFB UDP out port')
     parser.add_argument('--log-level', help='Log level', default='INFO')
     parser.add_argument('--root-dir', type=str, required=True, help='Root directory to serve')
+    parser.add_argument('--window', type=int, default=FtpServer.WINDOW_SIZE, help='Max chunks in flight per session')
+    parser.add_argument('--max-rate', type=int, default=FtpServer.MAX_RATE // 1024, help='Max send rate kB/s, 0 - no pacing')
+    parser.add_argument('--fixed-rate', action='store_true', help='Pace at max rate, no congestion control')
+    parser.add_argument('--mtu', type=int, default=RadioLink.MTU, help='wfb_tx radio MTU, chunks are sized to fill it')
+    parser.add_argument('--radio-fec', type=str, default='{}/{}'.format(RadioLink.FEC_K, RadioLink.FEC_N),
+                        help='wfb_tx FEC k/n, bursts are aligned to k datagrams')
+    parser.add_argument('--probe-mtu', action='store_true', help='Probe the link MTU before each transfer')
+    parser.add_argument('--stats-port', type=int, help='Local UDP port answering with transfer metrics JSON')
+    parser.add_argument('--cache-size', type=int, default=ChunkCache.BUDGET // 1024 // 1024,
+                        help='MB of encoded chunks kept for files served again, 0 - no cache')
+    parser.add_argument('--batch-io', action='store_true', help='Batch UDP syscalls with sendmmsg/recvmmsg (Linux)')
+    parser.add_argument('--push', action='append', default=[], help='Multicast the file to ground stations on start, repeatable')
+    parser.add_argument('--receivers', type=str, help='Node ids to push to, e.g. 1,2,3 (default: whoever joins)')
+    parser.add_argument('--push-fec', type=str, default='8/2', help='Push FEC k/m, parity repairs need m > 0')
+    parser.add_argument('--push-compress', choices=sorted(Codec.names), default='none', help='Push compression codec')
 
     args = parser.parse_args()
+    try:
+        push_fec_k, push_fec_m = (int(v) for v in args.push_fec.split('/'))
+        receivers = None if args.receivers is None else [int(v) for v in args.receivers.split(',')]
+        fec_k, fec_n = (int(v) for v in args.radio_fec.split('/'))
+    except ValueError:
+        parser.error('--push-fec and --radio-fec are k/m, --receivers comma separated node ids')
+    if not 0 <= push_fec_m <= push_fec_k <= 255:
+        parser.error('--push-fec needs 0 <= m <= k <= 255')
+    if not 1 <= fec_k <= fec_n:
+        parser.error('--radio-fec needs 1 <= k <= n')
+    link = RadioLink(args.mtu, fec_k, fec_n)
+    # a listing entry of the longest name GET_FILE can request, 50 bytes
+    entry_size = ListPageMessage.entry_size(bytes(50), GetListMessage.HASHES)
+    if link.chunk_size() <= 0 or link.max_runs() < 1 or link.list_entries_size() < entry_size:
+        parser.error('--mtu {} is too small for chunks and listings'.format(args.mtu))
     logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)-8s %(name)s: %(message)s")
-    
-    server = FtpServer(args.inport, args.outport, args.root_dir)
 
-    asyncio.run(server.start())
+    server = FtpServer(args.inport, args.outport, args.root_dir, window=args.window,
+                       max_rate=args.max_rate * 1024, rate_control=not args.fixed_rate,
+                       link=link, probe_mtu=args.probe_mtu, stats_port=args.stats_port,
+                       batch_io=args.batch_io, cache_size=args.cache_size * 1024 * 1024)
+
+
+    async def main():
+        server_task = asyncio.create_task(server.start())
+        await asyncio.sleep(0.5)
+        for name in args.push:
+            try:
+                await server.push_file(name, receivers, fec_k=push_fec_k, fec_m=push_fec_m,
+                                       codec=Codec.names[args.push_compress])
+            except (OSError, TimeoutError) as e:
+                # a failed push leaves the server serving downloads
+                logging.error("Push of %s failed: %s", name, e)
+        await server_task
+
+    asyncio.run(main())
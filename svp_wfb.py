@@ -8,6 +8,8 @@ import os
 
 from pymavlink.dialects.v20 import common
 
+import udp_batch
+
 """
 # air
 ## bench
@@ -129,8 +131,9 @@ class GCSLinkProtocol:
 
 class MavProxy:
 
-    def __init__(self, mode, mavlink, telem_chan):
+    def __init__(self, mode, mavlink, telem_chan, batch_io=False):
         self.mode = mode
+        self.batch_io = batch_io
         self.telem_chan = telem_chan
         self.mavlink = mavlink.split(':')[0], int(mavlink.split(':')[1])
         self.mav = common.MAVLink(None, srcSystem=1, srcComponent=1)
@@ -175,25 +178,25 @@ class MavProxy:
     async def start(self):
         logger.info("Starting MAV Proxy")
         loop = asyncio.get_running_loop()
-        uplink, _ = await loop.create_datagram_endpoint(
+        uplink, _ = await udp_batch.create_datagram_endpoint(
             lambda: UDPUplinkProtocol(),
-            remote_addr=('127.0.0.1', 5557))
+            remote_addr=('127.0.0.1', 5557), batched=self.batch_io)
 
         if self.mode == 'ground':
-            gs_link, gs_proto = await loop.create_datagram_endpoint(
+            gs_link, gs_proto = await udp_batch.create_datagram_endpoint(
                 lambda: GCSLinkProtocol(uplink),
-                remote_addr=self.mavlink, local_addr=('0.0.0.0', 5999))
+                remote_addr=self.mavlink, local_addr=('0.0.0.0', 5999), batched=self.batch_io)
             # gs_link, gs_proto = await loop.create_datagram_endpoint(
             #     lambda: GCSLinkProtocol(uplink),
             #     local_addr=self.mavlink)
         else:
-            gs_link, gs_proto = await loop.create_datagram_endpoint(
+            gs_link, gs_proto = await udp_batch.create_datagram_endpoint(
                 lambda: GCSLinkProtocol(uplink),
-                local_addr=self.mavlink)
+                local_addr=self.mavlink, batched=self.batch_io)
 
-        _, downlink_proto = await loop.create_datagram_endpoint(
+        _, downlink_proto = await udp_batch.create_datagram_endpoint(
             lambda: UDPDownlinkProtocol(gs_proto),
-            local_addr=('127.0.0.1', 5556))
+            local_addr=('127.0.0.1', 5556), batched=self.batch_io)
 
         asyncio.create_task(self.report(gs_proto, downlink_proto, gs_link))
 
@@ -338,7 +341,7 @@ async def main(args):
     ft_chan = Channel('ft', args.mode, args.iface, [3, 4], args.fec, 6557, 6556)
     telem_chan = Channel('telem', args.mode, args.iface, [5, 6], args.fec, 5557, 5556)
 
-    mav_proxy = MavProxy(args.mode, args.mavlink, telem_chan)
+    mav_proxy = MavProxy(args.mode, args.mavlink, telem_chan, args.batch_io)
 
     await bench_chan.start()
     await ft_chan.start()
@@ -430,6 +433,7 @@ if __name__ == '__main__':
     parser.add_argument('--freq', type=int, default=2432, help='WiFi frequency default 2432')
     parser.add_argument('--txpower', type=int, default=58, help='TX power (20-63) default  58')
     parser.add_argument('--bitrate', type=float, default=11, help='bitrate (2, 5.5, 11) default 11')
+    parser.add_argument('--batch-io', action='store_true', help='Batch MAVLink UDP syscalls with sendmmsg/recvmmsg (Linux)')
     parser.add_argument('iface', type=str, help='Wlan iface to use')
 
     args = parser.parse_args()
@@ -0,0 +1,294 @@
+"""
+Batched UDP datagram transport: recvmmsg drains the socket on each readiness
+callback, sendto() queues datagrams and sendmmsg flushes them once per event
+loop iteration. Protocols see a regular asyncio datagram transport; without
+Linux libc support create_datagram_endpoint falls back to the loop's own
+"""
+
+import asyncio
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import socket
+import struct
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint16),  # network order
+        ('sin_addr', ctypes.c_uint8 * 4),
+        ('sin_zero', ctypes.c_uint8 * 8),
+    ]
+
+
+def load_libc():
+    """
+    libc with sendmmsg/recvmmsg, None where they are missing (not Linux)
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        sendmmsg, recvmmsg = libc.sendmmsg, libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return libc
+
+
+libc = load_libc()
+
+
+def available():
+    return libc is not None
+
+
+class BatchedDatagramTransport(asyncio.DatagramTransport):
+    """
+    IPv4 datagram transport over a non blocking socket, up to BATCH datagrams
+    per syscall each way. Sends queue up to MAX_PENDING datagrams while the
+    socket is full, more are dropped like a full socket buffer would
+    """
+
+    BATCH = 32
+    MAX_PENDING = 1024
+
+    def __init__(self, loop, sock, protocol, address=None, max_size=2048):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._protocol = protocol
+        self._address = address  # peer of a connected socket, like asyncio's transport
+        self._extra = {'socket': sock, 'sockname': sock.getsockname(), 'peername': address}
+        self._closing = False
+        self._reading = False
+        self._writing = False
+        self._flush_handle = None
+        self.pending = collections.deque()
+        self.dropped = 0
+        self.max_size = max_size
+
+        self.recv_buffers = [ctypes.create_string_buffer(max_size) for _ in range(self.BATCH)]
+        self.recv_names = (sockaddr_in * self.BATCH)()
+        self.recv_iov = (iovec * self.BATCH)()
+        self.recv_msgs = (mmsghdr * self.BATCH)()
+        for i, buffer in enumerate(self.recv_buffers):
+            self.recv_iov[i].iov_base = ctypes.addressof(buffer)
+            self.recv_iov[i].iov_len = max_size
+            hdr = self.recv_msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.recv_names[i])
+            hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self.recv_iov[i])
+            hdr.msg_iovlen = 1
+        self.send_iov = (iovec * self.BATCH)()
+        self.send_msgs = (mmsghdr * self.BATCH)()
+        for i in range(self.BATCH):
+            self.send_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.send_iov[i])
+            self.send_msgs[i].msg_hdr.msg_iovlen = 1
+        self.send_names = {}  # (host, port) -> sockaddr_in
+        self.peer_names = {}  # raw sockaddr -> (host, port)
+
+        loop.call_soon(protocol.connection_made, self)
+        loop.call_soon(self.resume_reading)
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def is_reading(self):
+        return self._reading
+
+    def pause_reading(self):
+        if self._reading:
+            self._reading = False
+            self._loop.remove_reader(self._fd)
+
+    def resume_reading(self):
+        if not self._reading and not self._closing:
+            self._reading = True
+            self._loop.add_reader(self._fd, self.read_ready)
+
+    def get_write_buffer_size(self):
+        return sum(len(data) for data, _ in self.pending)
+
+    def read_ready(self):
+        count = libc.recvmmsg(self._fd, self.recv_msgs, self.BATCH, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self._protocol.error_received(OSError(err, errno.errorcode.get(err, str(err))))
+            return
+        for i in range(count):
+            msg = self.recv_msgs[i]
+            hdr = msg.msg_hdr
+            data = ctypes.string_at(self.recv_buffers[i], msg.msg_len)
+            truncated = hdr.msg_flags & socket.MSG_TRUNC
+            name = bytes(self.recv_names[i])
+            hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            hdr.msg_flags = 0
+            if truncated:
+                logger.warning("Datagram over %s bytes truncated, dropped", self.max_size)
+                continue
+            addr = self.peer_names.get(name)
+            if addr is None:
+                port, host = struct.unpack_from('!H4s', name, 2)  # after the native order family
+                addr = self.peer_names[name] = (socket.inet_ntoa(host), port)
+            self._protocol.datagram_received(data, addr)
+            if self._closing:
+                break
+
+    def sendto(self, data, addr=None):
+        if self._closing:
+            return
+        if len(self.pending) >= self.MAX_PENDING:
+            self.dropped += 1
+            return
+        if addr == self._address:
+            addr = None
+        self.pending.append((bytes(data), addr))
+        if self._flush_handle is None and not self._writing:
+            self._flush_handle = self._loop.call_soon(self.flush)
+
+    def sockaddr(self, addr):
+        name = self.send_names.get(addr)
+        if name is None:
+            host, port = addr
+            name = sockaddr_in(socket.AF_INET, socket.htons(port),
+                               (ctypes.c_uint8 * 4)(*socket.inet_aton(host)))
+            self.send_names[addr] = name
+        return name
+
+    def flush(self):
+        self._flush_handle = None
+        pending = self.pending
+        while pending:
+            batch = [pending[i] for i in range(min(len(pending), self.BATCH))]
+            for i, (data, addr) in enumerate(batch):
+                self.send_iov[i].iov_base = ctypes.cast(data, ctypes.c_void_p)
+                self.send_iov[i].iov_len = len(data)
+                hdr = self.send_msgs[i].msg_hdr
+                if addr is None:
+                    hdr.msg_name = None
+                    hdr.msg_namelen = 0
+                else:
+                    hdr.msg_name = ctypes.addressof(self.sockaddr(addr))
+                    hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            count = libc.sendmmsg(self._fd, self.send_msgs, len(batch), socket.MSG_DONTWAIT)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    if not self._writing:
+                        self._writing = True
+                        self._loop.add_writer(self._fd, self.write_ready)
+                    return
+                if err != errno.EINTR:
+                    # the first datagram failed, e.g. ECONNREFUSED of a connected socket
+                    pending.popleft()
+                    self._protocol.error_received(OSError(err, errno.errorcode.get(err, str(err))))
+                continue
+            for _ in range(count):
+                pending.popleft()
+        if self._writing:
+            self._writing = False
+            self._loop.remove_writer(self._fd)
+        if self._closing:
+            self.call_connection_lost(None)
+
+    def write_ready(self):
+        self.flush()
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self.pause_reading()
+        if self._flush_handle is None and not self._writing:
+            self._loop.call_soon(self.call_connection_lost, None)
+
+    def abort(self):
+        self.pending.clear()
+        self._closing = True
+        self.pause_reading()
+        if self._writing:
+            self._writing = False
+            self._loop.remove_writer(self._fd)
+        self._loop.call_soon(self.call_connection_lost, None)
+
+    def call_connection_lost(self, exc):
+        if self._sock is None:
+            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._writing:
+            self._writing = False
+            self._loop.remove_writer(self._fd)
+        self._sock.close()
+        self._sock = None
+        self._protocol.connection_lost(exc)
+
+
+async def create_datagram_endpoint(protocol_factory, local_addr=None, remote_addr=None, batched=True,
+                                   max_size=2048):
+    """
+    Like loop.create_datagram_endpoint for IPv4, returns (transport, protocol).
+    With `batched` and sendmmsg/recvmmsg available the transport batches
+    syscalls, otherwise it is the loop's regular datagram transport
+    """
+    loop = asyncio.get_running_loop()
+    if not (batched and available()):
+        return await loop.create_datagram_endpoint(protocol_factory, local_addr=local_addr, remote_addr=remote_addr)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        if local_addr is not None:
+            sock.bind(local_addr)
+        address = None
+        if remote_addr is not None:
+            infos = await loop.getaddrinfo(*remote_addr, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            address = infos[0][4]
+            await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    protocol = protocol_factory()
+    transport = BatchedDatagramTransport(loop, sock, protocol, address, max_size)
+    return transport, protocol
@@ -1,16 +1,23 @@
 import argparse
 import asyncio
+import collections
 import string
 import sys
 import struct
 import time
 
+import udp_batch
+
 """
 Run at ~ 150kB/s [ground]
 python3 wfb_bench.py --inport=5556 --outport=5557 --statport=5800 --packetsize=240 --sendpause=0.0001
 
 Run at ~ 150kB/s [air]
 python3 wfb_bench.py --inport=5558 --outport=5555 --statport=5801 --packetsize=240 --sendpause=0.0001
+
+Paced at 20 Mbit/s, or stepping 5 -> 40 Mbit/s for 5 s each to find where the link saturates
+python3 wfb_bench.py --inport=5556 --outport=5557 --statport=5800 --packetsize=1400 --rate=20000 --mode=ground
+python3 wfb_bench.py --inport=5556 --outport=5557 --statport=5800 --packetsize=1400 --rate=5000 --ramp=5000:40000:5000:5 --mode=ground
 """
 
 
@@ -62,6 +69,7 @@ class BaseProtocol:
         self.latency = 0
         self.recv_packet_no = 0
         self.remote_addr = None
+        self.stat_received = False
         self.stat = Stat()
         self.remote_stat = Stat()
         self.local_stat = Stat()
@@ -120,6 +128,7 @@ class BaseProtocol:
         
         if data[:5] == b'stat:':
             pr, br, ps, bs, loss, latency, rssi = struct.unpack('>LLLLLQi', data[5:])
+            self.stat_received = True
             self.remote_stat.update(
                 packets_recv_cnt = pr,
                 bytes_recv_cnt = br,
@@ -191,6 +200,139 @@ async def send_loop(loop, out_proto, packetsize, sendpause):
         await asyncio.sleep(sendpause)
 
 
+class Pacer:
+    """
+    Packet schedule of the --rate/--pps modes. Packets due are counted from
+    the moment the rate was set, so a late wakeup is made up by the next
+    batch instead of lowering the rate. Up to `burst` packets go per wakeup,
+    whatever a longer stall or a full socket misses is skipped
+    """
+
+    BURST_TIME = 0.02  # default burst, seconds worth of packets
+    MIN_SLEEP = 0.001
+
+    def __init__(self, pps, packet_bytes, burst=0):
+        self.packet_bytes = packet_bytes
+        self.burst_packets = burst
+        self.skipped = 0
+        self.set_rate(pps)
+
+    def set_rate(self, pps):
+        self.pps = pps
+        self.burst = self.burst_packets or max(1, int(pps * self.BURST_TIME))
+        self.start = time.monotonic()
+        self.scheduled = 0
+
+    def rate(self):
+        return self.pps * self.packet_bytes
+
+    def due(self):
+        due = int((time.monotonic() - self.start) * self.pps) - self.scheduled
+        if due > self.burst:
+            self.skip(due - self.burst)
+            due = self.burst
+        return due
+
+    def skip(self, count):
+        self.scheduled += count
+        self.skipped += count
+
+    def sent(self, count):
+        self.scheduled += count
+
+    def wait_time(self):
+        next_at = self.start + (self.scheduled + 1) / self.pps
+        return max(self.MIN_SLEEP, next_at - time.monotonic())
+
+
+class Ramp:
+    """
+    Steps the pacer through `rates`, holding each for `hold` report seconds.
+    The first second of a step settles and is not counted. A step sent or
+    received by the remote side under SATURATION of the requested rate
+    saturates the link
+    """
+
+    SATURATION = 0.95
+    HOLD = 5
+
+    def __init__(self, pacer, rates, hold, unit, to_pps):
+        self.pacer = pacer
+        self.rates = rates
+        self.hold = hold
+        self.unit = unit
+        self.to_pps = to_pps
+        self.step = 0
+        self.ticks = 0
+        self.totals = collections.Counter()
+        self.results = []
+        self.done = asyncio.Event()
+        pacer.set_rate(to_pps(rates[0]))
+
+    def tick(self, elapsed, sent, received, lost, packets, remote):
+        self.ticks += 1
+        if self.ticks > 1:
+            self.totals.update(time=elapsed, sent=sent, received=received, lost=lost, packets=packets)
+        self.remote = remote
+        if self.ticks >= self.hold:
+            self.next_step()
+
+    def next_step(self):
+        totals = self.totals
+        requested = self.pacer.rate()
+        sent = totals['sent'] / totals['time']
+        received = totals['received'] / totals['time']
+        lost = totals['lost']
+        loss = lost / (totals['packets'] + lost) if totals['packets'] + lost else 0
+        saturated = sent < requested * self.SATURATION or (
+            self.remote and received < requested * self.SATURATION)
+        self.results.append((self.rates[self.step], saturated))
+        print()
+        print("{:>8} {:>15} {:>12} {:>12} {:>12} {:>9}".format(
+              'RAMP', 'Rate', 'Requested', 'Send', 'Remote recv', 'Loss'))
+        print("{:>8} {:>15} {} {} {} {:8.1f}% {}".format(
+              self.step + 1, '{:g}{}'.format(self.rates[self.step], self.unit), format_bytes_count(int(requested)),
+              format_bytes_count(int(sent)), format_bytes_count(int(received)) if self.remote else '{:>12}'.format('-'),
+              loss * 100, 'saturated' if saturated else 'ok'))
+
+        self.step += 1
+        self.ticks = 0
+        self.totals.clear()
+        if self.step < len(self.rates):
+            self.pacer.set_rate(self.to_pps(self.rates[self.step]))
+            return
+        self.summary()
+        self.done.set()
+
+    def summary(self):
+        print()
+        for rate, saturated in self.results:
+            if saturated:
+                print("Saturated at {:g}{}".format(rate, self.unit))
+                break
+            best = rate
+        else:
+            print("Not saturated up to {:g}{}".format(self.rates[-1], self.unit))
+            return
+        if self.results[0][1]:
+            print("Saturated already at the first step")
+        else:
+            print("Highest rate delivered {:g}{}".format(best, self.unit))
+
+
+async def paced_send_loop(out_proto, packetsize, pacer):
+    payload = enc_data[:packetsize]
+    while True:
+        due = pacer.due()
+        if out_proto.transport.get_write_buffer_size() > pacer.burst * len(payload):
+            pacer.skip(due)  # the socket does not keep up
+        else:
+            for _ in range(due):
+                out_proto.send(payload)
+            pacer.sent(due)
+        await asyncio.sleep(pacer.wait_time())
+
+
 async def send_stat_loop(out_proto):
     while True:
         out_proto.send_local_stat()
@@ -207,9 +349,13 @@ def format_bytes_count(bytes_cnt):
     return r
 
 
-async def report(loop, out_proto, in_proto, stat_proto):
+async def report(loop, out_proto, in_proto, stat_proto, pacer=None, ramp=None):
+    last = loop.time()
     while True:
         await asyncio.sleep(1)
+        now = loop.time()
+        elapsed = now - last
+        last = now
         out_proto.update_stat_and_reset()
         in_proto.update_stat_and_reset()
         out_proto.local_stat.bytes_recv_cnt = in_proto.stat.bytes_recv_cnt
@@ -243,9 +389,43 @@ async def report(loop, out_proto, in_proto, stat_proto):
         rssi = in_proto.remote_stat.rssi
         print("{:>8} {} {} {:8.1f}% {:8.3f}ms {:8d}dbm".format('REMOTE', r, s, l, latency, rssi))
 
-
-
-async def main(inport, outport, statport, packetsize, sendpause, mode):
+        if pacer:
+            # requested vs achieved send rate, skipped - packets the schedule missed
+            requested = pacer.rate()
+            sent = out_proto.stat.bytes_send_cnt / elapsed
+            print("{:>8} {} {} {:8.1f}% {:>7}pps {:>8} skipped".format(
+                  'TARGET', format_bytes_count(int(requested)), format_bytes_count(int(sent)),
+                  sent / requested * 100, int(out_proto.stat.packets_send_cnt / elapsed), pacer.skipped))
+            pacer.skipped = 0
+
+        if ramp:
+            ramp.tick(elapsed, out_proto.stat.bytes_send_cnt, in_proto.remote_stat.bytes_recv_cnt,
+                      in_proto.remote_stat.lost_cnt, in_proto.remote_stat.packets_recv_cnt,
+                      in_proto.stat_received)
+
+
+
+def parse_ramp(text):
+    """
+    'start:stop:step[:seconds]' -> (rates, seconds per rate)
+    """
+    values = [float(v) for v in text.split(':')]
+    if len(values) not in (3, 4):
+        raise ValueError('Ramp is start:stop:step[:seconds]')
+    start, stop, step = values[:3]
+    hold = int(values[3]) if len(values) == 4 else Ramp.HOLD
+    if start <= 0 or step <= 0 or stop < start or hold < 2:
+        raise ValueError('Ramp needs 0 < start <= stop, step > 0 and at least 2 seconds per rate')
+    rates = []
+    rate = start
+    while rate <= stop * 1.000001:
+        rates.append(rate)
+        rate += step
+    return rates, hold
+
+
+async def main(inport, outport, statport, packetsize, sendpause, mode, rate=None, pps=None, burst=0,
+               ramp=None, batch_io=False):
     print("Starting UDP traffic gen")
 
     # Get a reference to the event loop as we plan to use
@@ -253,9 +433,9 @@ async def main(inport, outport, statport, packetsize, sendpause, mode):
     loop = asyncio.get_running_loop()
 
 
-    _, out_proto = await loop.create_datagram_endpoint(
+    _, out_proto = await udp_batch.create_datagram_endpoint(
         OutputProtocol,
-        remote_addr=('127.0.0.1', outport))
+        remote_addr=('127.0.0.1', outport), batched=batch_io)
 
     _, in_proto = await loop.create_datagram_endpoint(
         lambda: InputProtocol(out_proto),
@@ -265,12 +445,31 @@ async def main(inport, outport, statport, packetsize, sendpause, mode):
         lambda: LinkStatusProtocol(mode),
         local_addr=('127.0.0.1', statport))
 
-    send_task = asyncio.ensure_future(send_loop(loop, out_proto, packetsize, sendpause))
+    pacer = None
+    ramp_steps = None
+    if rate or pps:
+        packet_bytes = packetsize + 4  # with the packet number
+        if rate:
+            unit = 'kbit/s'
+            to_pps = lambda kbits: kbits * 1000 / 8 / packet_bytes
+        else:
+            unit = 'pps'
+            to_pps = lambda pps: pps
+        pacer = Pacer(to_pps(rate or pps), packet_bytes, burst)
+        if ramp:
+            rates, hold = parse_ramp(ramp)
+            ramp_steps = Ramp(pacer, rates, hold, unit, to_pps)
+        send_task = asyncio.ensure_future(paced_send_loop(out_proto, packetsize, pacer))
+    else:
+        send_task = asyncio.ensure_future(send_loop(loop, out_proto, packetsize, sendpause))
     send_stat_task = asyncio.ensure_future(send_stat_loop(out_proto))
-    report_task = asyncio.ensure_future(report(loop, out_proto, in_proto, stat_proto))
+    report_task = asyncio.ensure_future(report(loop, out_proto, in_proto, stat_proto, pacer, ramp_steps))
 
     try:
-        await asyncio.sleep(3600 * 12)  # Serve for 12 hour.
+        if ramp_steps:
+            await ramp_steps.done.wait()
+        else:
+            await asyncio.sleep(3600 * 12)  # Serve for 12 hour.
     finally:
         pass
 
@@ -282,10 +481,25 @@ if __name__ == '__main__':
     parser.add_argument('--outport', type=int, required=True, help='UDP out port')
     parser.add_argument('--statport', type=int, required=True, help='UDP WFB status port')
     parser.add_argument('--packetsize', type=int, required=True, help='Send packet size')
-    parser.add_argument('--sendpause', type=float, required=True, help='Send packet pause')
+    send_rate = parser.add_mutually_exclusive_group(required=True)
+    send_rate.add_argument('--sendpause', type=float, help='Send packet pause')
+    send_rate.add_argument('--rate', type=float, help='Target send rate kbit/s of UDP payload')
+    send_rate.add_argument('--pps', type=float, help='Target send rate packets/s')
+    parser.add_argument('--burst', type=int, default=0, help='Max packets sent per wakeup with --rate/--pps (default: 20 ms worth)')
+    parser.add_argument('--ramp', type=str, help="Step the --rate/--pps value 'start:stop:step[:seconds]' and report where the link saturates")
+    parser.add_argument('--batch-io', action='store_true', help='Batch UDP sends with sendmmsg (Linux)')
     parser.add_argument('--mode', type=str, required=True, help='Instance mode - air or ground')
 
     args = parser.parse_args()
+    if (args.rate is not None and args.rate <= 0) or (args.pps is not None and args.pps <= 0):
+        parser.error('--rate/--pps must be positive')
+    if args.ramp:
+        if args.sendpause is not None:
+            parser.error('--ramp needs --rate or --pps')
+        try:
+            parse_ramp(args.ramp)
+        except ValueError as e:
+            parser.error(str(e))
     
     main_coro = main(
         inport=args.inport,
@@ -294,6 +508,11 @@ if __name__ == '__main__':
         packetsize=args.packetsize,
         sendpause=args.sendpause,
         mode=args.mode,
+        rate=args.rate,
+        pps=args.pps,
+        burst=args.burst,
+        ramp=args.ramp,
+        batch_io=args.batch_io,
     )
 
     asyncio.run(main_coro)
\ No newline at end of file
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import collections
+import logging
+import random
+
+"""
+Lossy radio link emulator: UDP proxy from the ports wfb_tx reads to the ports
+wfb_rx delivers to, so wfb_ft and wfb_bench run on one machine without radios
+
+python3 wfb_emu.py --loss 0.05 --delay 5 --jitter 2 --fec 8/12
+# air
+python3 ft_server.py --inport=6558 --outport=6555 --root-dir=/tmp/ftroot
+python3 wfb_bench.py --inport=7558 --outport=7555 --statport=5801 --packetsize=240 --sendpause=0.001 --mode=air
+# ground
+python3 ft_client.py --inport=6556 --outport=6557 file.bin
+python3 wfb_bench.py --inport=7556 --outport=7557 --statport=5800 --packetsize=240 --sendpause=0.001 --mode=ground
+"""
+
+logger = logging.getLogger(__name__)
+
+# wfb_tx udp port -> wfb_rx client port, ft and bench channels in both directions
+LINKS = [(6555, 6556), (6557, 6558), (7555, 7556), (7557, 7558)]
+
+
+class LinkProfile:
+    """
+    Impairments of one link direction, times in ms, rate in kB/s (0 - unlimited).
+    Loss is per radio packet: plain random `loss`, plus Gilbert-Elliott bursts
+    when burst_p > 0. With fec_k wfb FEC blocks are emulated: k datagrams and
+    n - k parity packets, a block loses data only when more than n - k are lost
+    """
+
+    FIELDS = {
+        'loss': float, 'burst_p': float, 'burst_r': float, 'burst_loss': float,
+        'delay': float, 'jitter': float, 'reorder': float, 'reorder_delay': float,
+        'duplicate': float, 'rate': float, 'queue': int, 'fec_k': int, 'fec_n': int,
+    }
+
+    def __init__(self, loss=0.0, burst_p=0.0, burst_r=1.0, burst_loss=1.0, delay=0.0, jitter=0.0,
+                 reorder=0.0, reorder_delay=10.0, duplicate=0.0, rate=0.0, queue=200, fec_k=0, fec_n=0):
+        self.loss = loss
+        self.burst_p = burst_p  # good -> bad state per packet
+        self.burst_r = burst_r  # bad -> good state per packet
+        self.burst_loss = burst_loss  # loss in the bad state
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay  # extra delay of reordered datagrams
+        self.duplicate = duplicate
+        self.rate = rate
+        self.queue = queue  # datagrams waiting for airtime, like the wfb_tx socket buffer
+        self.fec_k = fec_k
+        self.fec_n = fec_n
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Profile from 'loss=0.05,delay=20,fec=8/12', empty text is a clean link
+        """
+        kwargs = {}
+        for item in filter(None, text.split(',')):
+            name, value = item.split('=')
+            if name == 'fec':
+                kwargs['fec_k'], kwargs['fec_n'] = (int(v) for v in value.split('/'))
+            elif name in cls.FIELDS:
+                kwargs[name] = cls.FIELDS[name](value)
+            else:
+                raise ValueError('Unknown link parameter {}'.format(name))
+        return cls(**kwargs)
+
+    def __str__(self):
+        default = LinkProfile()
+        items = ['{}={}'.format(name, getattr(self, name)) for name in self.FIELDS
+                 if not name.startswith('fec') and getattr(self, name) != getattr(default, name)]
+        if self.fec_k:
+            items.append('fec={}/{}'.format(self.fec_k, self.fec_n))
+        return ','.join(items) or 'clean'
+
+
+class GilbertElliott:
+    """
+    Two state packet loss, p = 0 leaves plain random loss of the good state
+    """
+
+    def __init__(self, loss_good, p, r, loss_bad, rng):
+        self.loss_good = loss_good
+        self.p = p
+        self.r = r
+        self.loss_bad = loss_bad
+        self.rng = rng
+        self.bad = False
+
+    def lost(self):
+        if self.bad:
+            self.bad = self.rng.random() >= self.r
+        else:
+            self.bad = self.rng.random() < self.p
+        return self.rng.random() < (self.loss_bad if self.bad else self.loss_good)
+
+
+class ImpairedLink:
+    """
+    One direction of the emulated radio: datagrams received on the wfb_tx port
+    go to the wfb_rx port through the airtime queue, loss/FEC and delay
+    """
+
+    def __init__(self, profile, dst_port, rng=None):
+        self.profile = profile
+        self.dst = ('127.0.0.1', dst_port)
+        self.rng = rng or random.Random()
+        self.loss = GilbertElliott(profile.loss, profile.burst_p, profile.burst_r, profile.burst_loss, self.rng)
+        self.block = []  # data of lost datagrams of the current FEC block, None for delivered ones
+        self.busy_until = 0
+        self.stats = collections.Counter()
+        self.kinds = collections.Counter()  # datagrams by first byte, wfb_ft command
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    def airtime(self, size):
+        """
+        Time the packet leaves the radio, None when the queue is full
+        """
+        now = asyncio.get_running_loop().time()
+        if not self.profile.rate:
+            return now
+        start = max(now, self.busy_until)
+        duration = size / (self.profile.rate * 1024)
+        if (start - now) / duration > self.profile.queue:
+            return None
+        self.busy_until = start + duration
+        return self.busy_until
+
+    def datagram_received(self, data, addr):
+        self.stats['in'] += 1
+        self.kinds[data[0]] += 1
+        sent_at = self.airtime(len(data))
+        if sent_at is None:
+            self.stats['queue_drop'] += 1
+            return
+        lost = self.loss.lost()
+        if not lost:
+            self.deliver(data, sent_at)
+        if self.profile.fec_k:
+            self.add_to_block(data if lost else None, len(data))
+        elif lost:
+            self.stats['lost'] += 1
+
+    def add_to_block(self, lost_data, size):
+        """
+        wfb_tx sends parity once k datagrams are in, a block lingers until then
+        """
+        self.block.append(lost_data)
+        if len(self.block) < self.profile.fec_k:
+            return
+        parity_lost = 0
+        sent_at = None
+        for _ in range(self.profile.fec_n - self.profile.fec_k):
+            self.stats['parity'] += 1
+            sent_at = self.airtime(size) or sent_at
+            parity_lost += self.loss.lost()
+        missing = [data for data in self.block if data is not None]
+        self.block = []
+        if not missing:
+            return
+        if len(missing) + parity_lost <= self.profile.fec_n - self.profile.fec_k:
+            self.stats['recovered'] += len(missing)
+            for data in missing:
+                self.deliver(data, sent_at or asyncio.get_running_loop().time())
+        else:
+            self.stats['lost'] += len(missing)
+
+    def deliver(self, data, sent_at):
+        profile = self.profile
+        at = sent_at + (profile.delay + self.rng.uniform(-profile.jitter, profile.jitter)) / 1000
+        if profile.reorder and self.rng.random() < profile.reorder:
+            self.stats['reordered'] += 1
+            at += profile.reorder_delay / 1000
+        copies = 1
+        if profile.duplicate and self.rng.random() < profile.duplicate:
+            self.stats['duplicated'] += 1
+            copies = 2
+        loop = asyncio.get_running_loop()
+        for _ in range(copies):
+            self.stats['out'] += 1
+            if at <= loop.time():
+                self.transport.sendto(data, self.dst)
+            else:
+                loop.call_at(at, self.transport.sendto, data, self.dst)
+
+
+async def start_links(profile, links=LINKS, seed=None):
+    """
+    Emulated links listening on the wfb_tx ports, returns [(transport, link)]
+    """
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    endpoints = []
+    for src_port, dst_port in links:
+        link = ImpairedLink(profile, dst_port, random.Random(rng.random()))
+        transport, _ = await loop.create_datagram_endpoint(lambda: link, local_addr=('127.0.0.1', src_port))
+        endpoints.append((transport, link))
+    return endpoints
+
+
+async def report(endpoints, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print()
+        print('{:>12} {:>8} {:>8} {:>8} {:>9} {:>8} {:>9} {:>9}'.format(
+            'link', 'in', 'out', 'lost', 'recovered', 'queue', 'reordered', 'duplicated'))
+        for transport, link in endpoints:
+            stats = link.stats
+            print('{:>12} {:>8} {:>8} {:>8} {:>9} {:>8} {:>9} {:>9}'.format(
+                '{}>{}'.format(transport.get_extra_info('sockname')[1], link.dst[1]), stats['in'], stats['out'],
+                stats['lost'], stats['recovered'], stats['queue_drop'], stats['reordered'], stats['duplicated']))
+            stats.clear()
+
+
+async def main(profile, links, seed, interval):
+    endpoints = await start_links(profile, links, seed)
+    print('Emulating {} on {}'.format(profile, ', '.join('{}>{}'.format(*link) for link in links)))
+    await report(endpoints, interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lossy wfb radio link emulator')
+
+    parser.add_argument('--loss', type=float, default=0.0, help='Random packet loss ratio')
+    parser.add_argument('--burst', type=str, help='Gilbert-Elliott bursts p/r[/loss]: good->bad and bad->good per packet, loss in bad state (1)')
+    parser.add_argument('--delay', type=float, default=0.0, help='One way delay ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Delay jitter ms, +/-')
+    parser.add_argument('--reorder', type=float, default=0.0, help='Ratio of datagrams delivered late')
+    parser.add_argument('--reorder-delay', type=float, default=10.0, help='Extra delay of reordered datagrams ms')
+    parser.add_argument('--duplicate', type=float, default=0.0, help='Ratio of duplicated datagrams')
+    parser.add_argument('--rate', type=float, default=0.0, help='Link capacity kB/s, 0 - unlimited')
+    parser.add_argument('--queue', type=int, default=200, help='Datagrams queued for airtime before drops')
+    parser.add_argument('--fec', type=str, default='0/0', help='wfb FEC k/n to emulate block loss, e.g. 8/12 (off by default)')
+    parser.add_argument('--links', type=str, default=','.join('{}:{}'.format(*link) for link in LINKS),
+                        help='Comma separated listen:deliver port pairs')
+    parser.add_argument('--seed', type=int, help='Random seed for reproducible runs')
+    parser.add_argument('--report-interval', type=float, default=1.0, help='Seconds between stats lines')
+
+    args = parser.parse_args()
+    fec_k, fec_n = (int(v) for v in args.fec.split('/'))
+    burst_p, burst_r, burst_loss = 0.0, 1.0, 1.0
+    if args.burst:
+        burst = [float(v) for v in args.burst.split('/')]
+        burst_p, burst_r = burst[:2]
+        if len(burst) > 2:
+            burst_loss = burst[2]
+    profile = LinkProfile(loss=args.loss, burst_p=burst_p, burst_r=burst_r, burst_loss=burst_loss,
+                          delay=args.delay, jitter=args.jitter, reorder=args.reorder,
+                          reorder_delay=args.reorder_delay, duplicate=args.duplicate, rate=args.rate,
+                          queue=args.queue, fec_k=fec_k, fec_n=fec_n)
+    links = [tuple(int(port) for port in pair.split(':')) for pair in args.links.split(',')]
+
+    asyncio.run(main(profile, links, args.seed, args.report_interval))
@@ -4,51 +4,166 @@ File transfer util for WFB bridge
 
 import argparse
 import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import string
 import sys
 import struct
 import time
 import pathlib
 import logging
+import lzma
+import math
+import multiprocessing
+import operator
+import os
+import queue
 import random
+import threading
+import zlib
+
+import udp_batch
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 logger = logging.getLogger(__name__)
 
 
 MAX_sequence = 4294967294
+PROTOCOL_VERSION = 2  # 1 is the original header without a version byte and 32 bit offsets
 
 
 class Command:
     GET_LIST = 1
-    SEND_LIST_ITEM = 2
+    LIST_PAGE = 2
     GET_FILE = 3
     SEND_CHUNK = 4
     ACK = 5
     NACK = 6
     TRANSFER_COMPLETE = 7
+    SACK = 8
+    PARITY = 9
+    RESUME_FILE = 10
+    FILE_INFO = 11
+    DELTA_FILE = 12
+    SIGNATURES = 13
+    DELTA_MATCHES = 14
+    PROBE = 15
+    ANNOUNCE = 16
+    FLUSH = 17
+
+
+class Codec:
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+    ZSTD = 3
+
+    names = {'none': NONE, 'zlib': ZLIB, 'lzma': LZMA, 'zstd': ZSTD}
+
+    @classmethod
+    def available(cls, codec):
+        return codec in (cls.NONE, cls.ZLIB, cls.LZMA) or (codec == cls.ZSTD and zstandard is not None)
+
+
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]  # raw stream, no container overhead per chunk
+
+
+def compress_chunk(codec, data):
+    """
+    Compressed chunk data, None when it doesn't get smaller
+    """
+    if codec == Codec.ZLIB:
+        packed = zlib.compress(data, 6)
+    elif codec == Codec.LZMA:
+        packed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    elif codec == Codec.ZSTD:
+        packed = zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        return None
+    return packed if len(packed) < len(data) else None
+
+
+def decompress_chunk(codec, data):
+    if codec == Codec.ZLIB:
+        return zlib.decompress(data)
+    elif codec == Codec.LZMA:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    elif codec == Codec.ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError('Unknown codec {}'.format(codec))
+
+
+def compression_ratio(codec, samples):
+    raw = sum(len(data) for data in samples)
+    packed = 0
+    for data in samples:
+        compressed = compress_chunk(codec, data)
+        packed += len(data) if compressed is None else len(compressed)
+    return packed / raw if raw else 1
 
 
 class Header:
+    """
+    cmd stays the first byte so datagrams are dispatched before the version is checked
+    """
 
-    def __init__(self, cmd, node_id, sequence):
+    __slots__ = ('cmd', 'version', 'node_id', 'sequence')
+    packer = struct.Struct('>BBHI')
+
+    def __init__(self, cmd, node_id, sequence, version=PROTOCOL_VERSION):
         self.cmd = cmd
+        self.version = version
         self.node_id = node_id
         self.sequence = sequence
 
     @classmethod
-    def unpack(cls, header_data):
-        cmd, node_id, sequence = struct.unpack('>BHI', header_data)
-        return cls(cmd=cmd, node_id=node_id, sequence=sequence)
+    def unpack_from(cls, data, offset=0):
+        cmd, version, node_id, sequence = cls.packer.unpack_from(data, offset)
+        return cls(cmd, node_id, sequence, version)
 
     def pack(self):
-        return struct.pack('>BHI', self.cmd, self.node_id, self.sequence)
+        return self.packer.pack(self.cmd, self.version, self.node_id, self.sequence)
+
+    def pack_into(self, buffer):
+        self.packer.pack_into(buffer, 0, self.cmd, self.version, self.node_id, self.sequence)
 
     def __repr__(self):
-        return 'c:{} n:{} s:{}'.format(self.cmd, self.node_id, self.sequence)
+        return 'c:{} v:{} n:{} s:{}'.format(self.cmd, self.version, self.node_id, self.sequence)
+
+
+class MessageType(type):
+    """
+    Message classes get `fields` as __slots__ and a precompiled struct_format packer,
+    `fixed_fields` are the ones in struct_format, a variable part may follow them
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', tuple(namespace.get('fields', ())))
+        cls = super().__new__(mcs, name, bases, namespace)
+        if 'struct_format' in namespace:
+            cls.packer = struct.Struct(cls.struct_format)
+            cls.fixed_fields = tuple(cls.fields[:len(cls.packer.unpack(bytes(cls.packer.size)))])
+            cls.variable = len(cls.fixed_fields) < len(cls.fields)
+            cls.datagram_size = Header.packer.size + cls.packer.size
+            getter = operator.attrgetter(*cls.fixed_fields)
+            if len(cls.fixed_fields) == 1:
+                cls.fixed_values = staticmethod(lambda msg: (getter(msg),))
+            else:
+                cls.fixed_values = getter
+        return cls
+
 
+class Message(metaclass=MessageType):
 
-class Message:
+    __slots__ = ('header',)
 
     def __init__(self, sequence, node_id, **fields):
         self.header = Header(cmd=self.COMMAND, sequence=sequence, node_id=node_id)
@@ -62,21 +177,37 @@ class Message:
         return [getattr(self, fname) for fname in self.fields]
 
     def pack(self):
-        return self.header.pack() + struct.pack(self.struct_format, *self.fields_list())
+        return self.header.pack() + self.packer.pack(*self.fields_list())
+
+    def pack_into(self, buffer):
+        """
+        Pack into a reusable bytearray, returns a memoryview of the datagram
+        """
+        if self.variable:
+            data = self.pack()
+            buffer[:len(data)] = data
+            return memoryview(buffer)[:len(data)]
+        header = self.header
+        Header.packer.pack_into(buffer, 0, header.cmd, header.version, header.node_id, header.sequence)
+        self.packer.pack_into(buffer, Header.packer.size, *self.fixed_values(self))
+        return memoryview(buffer)[:self.datagram_size]
 
     @classmethod
     def unpack(cls, data):
-        header_data = data[:7]
-        payload = data[7:] 
-        header = Header.unpack(header_data)
-        fields_values = struct.unpack(cls.struct_format, payload)
-        fields = dict(zip(cls.fields, fields_values))
-        return cls(header.sequence, header.node_id, **fields)
+        """
+        Decode a datagram (bytes or memoryview) without copying it, the variable
+        part is left to subclasses
+        """
+        msg = cls.__new__(cls)
+        msg.header = Header.unpack_from(data)
+        for name, value in zip(cls.fixed_fields, cls.packer.unpack_from(data, Header.packer.size)):
+            setattr(msg, name, value)
+        return msg
 
     def __repr__(self):
         fields_repr = []
         for f in self.fields:
-            fr = '{}={}'.format(f, getattr(self, f))
+            fr = '{}={}'.format(f, getattr(self, f, None))
             if len(fr) > 20:
                 fr = fr[:20] + '...'
             fields_repr.append(fr)
@@ -84,9 +215,13 @@ class Message:
 
 
 class GetListMessage(Message):
+    """
+    Listing request: up to `pages` LIST_PAGE datagrams with entries from `first` on
+    """
     COMMAND = Command.GET_LIST
-    struct_format = ''
-    fields = []
+    struct_format = '>IIBB'
+    fields = ['request_id', 'first', 'pages', 'flags']
+    HASHES = 1
 
 
 class AckMessage(Message):
@@ -95,63 +230,537 @@ class AckMessage(Message):
     fields = ['ack_sequence', 'ack']
 
 
-class SendListItemMessage(Message):
-    COMMAND = Command.SEND_LIST_ITEM
-    struct_format = '>I50s'
-    fields = ['size', 'name']
+class ListPageMessage(Message):
+    """
+    Directory index entries first...first + count - 1 of `total`,
+    `generation` changes whenever the index does, `last` ends the response
+    """
+    COMMAND = Command.LIST_PAGE
+    struct_format = '>IIIIHB?'
+    fields = ['request_id', 'generation', 'first', 'total', 'count', 'flags', 'last', 'entries']
+    entries_start = Header.packer.size + struct.calcsize(struct_format)
+    entry_header = struct.Struct('>QIB')  # size, mtime, name length
+    DIGEST_SIZE = 8
+
+    @classmethod
+    def entry_size(cls, name, flags):
+        return cls.entry_header.size + len(name) + (cls.DIGEST_SIZE if flags & GetListMessage.HASHES else 0)
+
+    def pack(self):
+        data = [self.header.pack(), self.packer.pack(self.request_id, self.generation, self.first,
+                                                    self.total, len(self.entries), self.flags, self.last)]
+        for name, size, mtime, digest in self.entries:
+            data.append(self.entry_header.pack(size, mtime, len(name)))
+            data.append(name)
+            if self.flags & GetListMessage.HASHES:
+                data.append(digest)
+        return b''.join(data)
+
+    @classmethod
+    def unpack(cls, data):
+        msg = super().unpack(data)
+        msg.entries = []
+        pos = cls.entries_start
+        for _ in range(msg.count):
+            size, mtime, name_length = cls.entry_header.unpack_from(data, pos)
+            pos += cls.entry_header.size
+            name = bytes(data[pos:pos + name_length])
+            pos += name_length
+            digest = None
+            if msg.flags & GetListMessage.HASHES:
+                digest = bytes(data[pos:pos + cls.DIGEST_SIZE])
+                pos += cls.DIGEST_SIZE
+            msg.entries.append((name, size, mtime, digest))
+        return msg
 
 
 class GetFileMessage(Message):
     COMMAND = Command.GET_FILE
-    struct_format = '>I50s'
-    fields = ['session_id', 'name']
+    struct_format = '>I50sBBBBB'
+    fields = ['session_id', 'name', 'fec_k', 'fec_m', 'codec', 'priority', 'weight']
+
+
+class ResumeFileMessage(Message):
+    """
+    GET_FILE continuing a partial download, `ranges` are [start, end) chunk
+    index ranges still missing for the file of given size and mtime (ns)
+    """
+    COMMAND = Command.RESUME_FILE
+    struct_format = '>I50sBBBBBQQHH'
+    fields = ['session_id', 'name', 'fec_k', 'fec_m', 'codec', 'priority', 'weight', 'size', 'mtime', 'chunk_size', 'ranges_count', 'ranges']
+    ranges_start = Header.packer.size + struct.calcsize(struct_format)
+    range_packer = struct.Struct('>II')
+
+    def pack(self):
+        return self.header.pack() + self.packer.pack(
+            self.session_id, self.name, self.fec_k, self.fec_m, self.codec,
+            self.priority, self.weight, self.size, self.mtime, self.chunk_size, len(self.ranges)) + b''.join(
+            self.range_packer.pack(start, end) for start, end in self.ranges)
+
+    @classmethod
+    def unpack(cls, data):
+        msg = super().unpack(data)
+        msg.ranges = list(cls.range_packer.iter_unpack(data[cls.ranges_start:cls.ranges_start + 8 * msg.ranges_count]))
+        return msg
+
+
+class FileInfoMessage(Message):
+    """
+    `codec` is the session compression chosen by the server, none for incompressible files
+    """
+    COMMAND = Command.FILE_INFO
+    struct_format = '>IQQH?B'
+    fields = ['session_id', 'size', 'mtime', 'chunk_size', 'resumed', 'codec']  # mtime in ns
+
+
+class DeltaFileMessage(Message):
+    """
+    GET_FILE against an older local copy, its `blocks_count` block signatures
+    are sent beforehand in SIGNATURES messages
+    """
+    COMMAND = Command.DELTA_FILE
+    struct_format = '>I50sBBBBBII'
+    fields = ['session_id', 'name', 'fec_k', 'fec_m', 'codec', 'priority', 'weight', 'block_size', 'blocks_count']
+
+
+class SignaturesMessage(Message):
+    """
+    Weak (adler32) and strong (8 bytes blake2b) signatures of local
+    blocks first_block...first_block + count - 1
+    """
+    COMMAND = Command.SIGNATURES
+    struct_format = '>IIH'
+    fields = ['session_id', 'first_block', 'count', 'signatures']
+    signatures_start = Header.packer.size + struct.calcsize(struct_format)
+    signature_packer = struct.Struct('>I8s')
+
+    def pack(self):
+        return self.header.pack() + self.packer.pack(
+            self.session_id, self.first_block, len(self.signatures)) + b''.join(
+            self.signature_packer.pack(weak, strong) for weak, strong in self.signatures)
+
+    @classmethod
+    def unpack(cls, data):
+        msg = super().unpack(data)
+        msg.signatures = list(cls.signature_packer.iter_unpack(
+            data[cls.signatures_start:cls.signatures_start + 12 * msg.count]))
+        return msg
+
+
+class DeltaMatchesMessage(Message):
+    """
+    Copy instructions of a delta transfer: each run (offset, block, count)
+    places `count` local blocks starting from `block` at file `offset`
+    """
+    COMMAND = Command.DELTA_MATCHES
+    struct_format = '>IHH'
+    fields = ['session_id', 'batch', 'count', 'runs']
+    runs_start = Header.packer.size + struct.calcsize(struct_format)
+    run_packer = struct.Struct('>QII')
+
+    def pack(self):
+        return self.header.pack() + self.packer.pack(
+            self.session_id, self.batch, len(self.runs)) + b''.join(
+            self.run_packer.pack(*run) for run in self.runs)
+
+    @classmethod
+    def unpack(cls, data):
+        msg = super().unpack(data)
+        msg.runs = list(cls.run_packer.iter_unpack(data[cls.runs_start:cls.runs_start + cls.run_packer.size * msg.count]))
+        return msg
 
 
 class TransferCompleteMessage(Message):
+    """
+    `digest` is blake2b of the whole file on the server
+    """
     COMMAND = Command.TRANSFER_COMPLETE
-    struct_format = '>I'
-    fields = ['session_id']
+    struct_format = '>I32s'
+    fields = ['session_id', 'digest']
+    DIGEST_SIZE = 32
+
+
+class SackMessage(Message):
+    """
+    Selective ACK: all chunks below `cumulative` are received,
+    bit i of `bitmap` (little endian) stands for chunk cumulative + 1 + i,
+    `delay` is how long the receiver held the ACK, in DELAY_UNIT seconds
+    """
+    COMMAND = Command.SACK
+    struct_format = '>IIH32s'
+    fields = ['session_id', 'cumulative', 'delay', 'bitmap']
+    BITMAP_BITS = 256
+    DELAY_UNIT = 0.0001
 
 
 class SendChunkMessage(Message):
+    """
+    `size` is the chunk size in the file, `data` is compressed with
+    the session codec when flags has COMPRESSED, `crc` is crc32 of
+    the uncompressed chunk
+    """
     COMMAND = Command.SEND_CHUNK
-    struct_format = '>IHI'
-    fields = ['session_id', 'offset', 'size', 'data']
+    struct_format = '>IIQHBI'
+    fields = ['session_id', 'index', 'offset', 'size', 'flags', 'crc', 'data']
+    __slots__ = tuple(fields) + ('encoded',)
+    data_start = Header.packer.size + struct.calcsize(struct_format)
+    session_packer = struct.Struct('>I')
+    encoded_packer = struct.Struct('>' + struct_format[2:])  # the fields after session_id
+    encoded_start = Header.packer.size + session_packer.size
+    COMPRESSED = 1
+
+    def __init__(self, sequence, node_id, **fields):
+        super().__init__(sequence, node_id, **fields)
+        self.encoded = None
+
+    @classmethod
+    def from_encoded(cls, sequence, node_id, session_id, encoded):
+        """
+        Chunk of another session resent: only the header and session_id are packed
+        """
+        msg = cls.__new__(cls)
+        msg.header = Header(cmd=cls.COMMAND, sequence=sequence, node_id=node_id)
+        msg.session_id = session_id
+        msg.index, msg.offset, msg.size, msg.flags, msg.crc = cls.encoded_packer.unpack_from(encoded)
+        msg.data = memoryview(encoded)[cls.encoded_packer.size:]
+        msg.encoded = encoded
+        return msg
+
+    def encode(self):
+        """
+        The datagram after session_id, same for every session sending the chunk
+        """
+        return self.encoded_packer.pack(self.index, self.offset, self.size, self.flags, self.crc) + self.data
+
+    def pack(self):
+        return self.header.pack() + self.packer.pack(
+            self.session_id, self.index, self.offset, self.size, self.flags, self.crc) + self.data
+
+    def pack_into(self, buffer):
+        self.header.pack_into(buffer)
+        if self.encoded is not None:
+            self.session_packer.pack_into(buffer, Header.packer.size, self.session_id)
+            end = self.encoded_start + len(self.encoded)
+            buffer[self.encoded_start:end] = self.encoded
+            return memoryview(buffer)[:end]
+        self.packer.pack_into(buffer, Header.packer.size, self.session_id, self.index, self.offset, self.size,
+                              self.flags, self.crc)
+        end = self.data_start + len(self.data)
+        buffer[self.data_start:end] = self.data
+        return memoryview(buffer)[:end]
+
+    @classmethod
+    def unpack(cls, data):
+        msg = super().unpack(data)
+        msg.data = data[cls.data_start:]
+        msg.encoded = None
+        return msg
+
+
+class ParityMessage(Message):
+    """
+    XOR parity number `parity_no` of block `block`, covers block chunks
+    with (index - first index) % fec_m == parity_no
+    """
+    COMMAND = Command.PARITY
+    struct_format = '>IIBBHH'
+    fields = ['session_id', 'block', 'parity_no', 'count', 'chunk_size', 'size_xor', 'data']
+    data_start = Header.packer.size + struct.calcsize(struct_format)
+
+    def pack(self):
+        return self.header.pack() + self.packer.pack(
+            self.session_id, self.block, self.parity_no,
+            self.count, self.chunk_size, self.size_xor) + self.data
+
+    def pack_into(self, buffer):
+        self.header.pack_into(buffer)
+        self.packer.pack_into(buffer, Header.packer.size, self.session_id, self.block, self.parity_no,
+                              self.count, self.chunk_size, self.size_xor)
+        end = self.data_start + len(self.data)
+        buffer[self.data_start:end] = self.data
+        return memoryview(buffer)[:end]
+
+    @classmethod
+    def unpack(cls, data):
+        msg = super().unpack(data)
+        msg.data = data[cls.data_start:]
+        return msg
+
+
+class ProbeMessage(Message):
+    """
+    Datagram padded to `size` bytes, acked by the client if it gets through the radio link
+    """
+    COMMAND = Command.PROBE
+    struct_format = '>IH'
+    fields = ['session_id', 'size', 'padding']
+
+    def pack(self):
+        data = self.header.pack() + self.packer.pack(self.session_id, self.size)
+        return data + bytes(self.size - len(data))
+
+    @classmethod
+    def unpack(cls, data):
+        msg = super().unpack(data)
+        msg.padding = None
+        return msg
+
+
+class AnnounceMessage(Message):
+    """
+    Multicast session offer, receivers join by acking it with their node id
+    """
+    COMMAND = Command.ANNOUNCE
+    struct_format = '>IQQHBBB50s'
+    fields = ['session_id', 'size', 'mtime', 'chunk_size', 'fec_k', 'fec_m', 'codec', 'name']  # mtime in ns
+
+
+class FlushMessage(Message):
+    """
+    End of a multicast round, every receiver answers with a NACK
+    """
+    COMMAND = Command.FLUSH
+    struct_format = '>II'
+    fields = ['session_id', 'round']
+
+
+class NackMessage(Message):
+    """
+    [start, end) chunk ranges a multicast receiver misses after `round`,
+    no ranges when it has the whole file. Unicast receivers send round 0
+    NACKs of the chunks skipped as soon as a later one arrives
+    """
+    COMMAND = Command.NACK
+    struct_format = '>IIH'
+    fields = ['session_id', 'round', 'ranges_count', 'ranges']
+    ranges_start = Header.packer.size + struct.calcsize(struct_format)
+    range_packer = struct.Struct('>II')
 
     def pack(self):
-        return self.header.pack() + struct.pack(self.struct_format, self.session_id, self.offset, self.size) + self.data
+        return self.header.pack() + self.packer.pack(self.session_id, self.round, len(self.ranges)) + b''.join(
+            self.range_packer.pack(start, end) for start, end in self.ranges)
 
     @classmethod
     def unpack(cls, data):
-        msg = super().unpack(data[:7+10])
-        msg.data = data[7+10:]
+        msg = super().unpack(data)
+        msg.ranges = list(cls.range_packer.iter_unpack(data[cls.ranges_start:cls.ranges_start + 8 * msg.ranges_count]))
         return msg
 
 
 messages = {
     Command.GET_LIST: GetListMessage,
-    Command.SEND_LIST_ITEM: SendListItemMessage,
+    Command.LIST_PAGE: ListPageMessage,
     Command.GET_FILE: GetFileMessage,
     Command.SEND_CHUNK: SendChunkMessage,
     Command.ACK: AckMessage,
     Command.TRANSFER_COMPLETE: TransferCompleteMessage,
+    Command.SACK: SackMessage,
+    Command.PARITY: ParityMessage,
+    Command.RESUME_FILE: ResumeFileMessage,
+    Command.FILE_INFO: FileInfoMessage,
+    Command.DELTA_FILE: DeltaFileMessage,
+    Command.SIGNATURES: SignaturesMessage,
+    Command.DELTA_MATCHES: DeltaMatchesMessage,
+    Command.PROBE: ProbeMessage,
+    Command.ANNOUNCE: AnnounceMessage,
+    Command.FLUSH: FlushMessage,
+    Command.NACK: NackMessage,
 } 
 
 
+class Histogram:
+    """
+    Power of two millisecond buckets: bucket i counts values below 2^i ms
+    """
+
+    BUCKETS = 16
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+
+    def add(self, seconds):
+        self.counts[min(int(seconds * 1000).bit_length(), self.BUCKETS - 1)] += 1
+
+    def snapshot(self):
+        return {'<{}ms'.format(1 << i): count for i, count in enumerate(self.counts) if count}
+
+
+class TransferStats:
+    """
+    Counters of one transfer, the packet path only does attribute increments
+    """
+
+    __slots__ = ('session_id', 'name', 'role', 'size', 'started', 'finished', 'bytes', 'goodput',
+                 'chunks_sent', 'retransmits', 'parity_sent', 'timeouts', 'sacks_received', 'nacked',
+                 'chunks_received', 'duplicates', 'broken', 'dropped', 'recovered', 'sacks_sent', 'sacks_lost',
+                 'nacks_sent', 'rtt')
+
+    COUNTERS = ('chunks_sent', 'retransmits', 'parity_sent', 'timeouts', 'sacks_received', 'nacked',
+                'chunks_received', 'duplicates', 'broken', 'dropped', 'recovered', 'sacks_sent', 'sacks_lost',
+                'nacks_sent')
+
+    def __init__(self, session_id, name, role, size):
+        self.session_id = session_id
+        self.name = name
+        self.role = role  # send or receive
+        self.size = size
+        self.started = time.monotonic()
+        self.finished = None
+        self.bytes = 0  # acked by the receiver / stored by the client
+        self.goodput = 0.0  # bytes/s over the last metrics sample
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.rtt = Histogram()
+
+    def snapshot(self, now):
+        elapsed = (self.finished or now) - self.started
+        snapshot = dict(session_id=self.session_id, name=self.name, role=self.role, size=self.size,
+                        bytes=self.bytes, elapsed=round(elapsed, 3), goodput=round(self.goodput),
+                        average_goodput=round(self.bytes / elapsed) if elapsed > 0 else 0)
+        snapshot.update((name, getattr(self, name)) for name in self.COUNTERS if getattr(self, name))
+        if self.chunks_sent:
+            snapshot['retransmit_ratio'] = round(self.retransmits / self.chunks_sent, 4)
+        rtt = self.rtt.snapshot()
+        if rtt:
+            snapshot['rtt'] = rtt
+        return snapshot
+
+
+class NodeMetrics:
+    """
+    Datagram counters by command, ack RTTs, event loop lag and the stats of
+    running and recently finished transfers. Sampled every LAG_INTERVAL,
+    summarized in the log and served as JSON to any datagram on the stats port:
+    echo | nc -u -w1 127.0.0.1 <stats port>
+    """
+
+    LAG_INTERVAL = 0.1
+    GOODPUT_INTERVAL = 1.0
+    FINISHED_KEPT = 16
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.sent = [0] * 256  # datagrams by command
+        self.received = [0] * 256
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.ack_timeouts = 0  # reliable messages repeated, the message or its ack was lost
+        self.ack_rtt = Histogram()
+        self.loop_lag = 0.0
+        self.max_loop_lag = 0.0
+        self.transfers = {}
+        self.finished = collections.deque(maxlen=self.FINISHED_KEPT)
+        self.last_bytes = {}
+        self.chunk_cache = None  # set by servers
+
+    def add(self, stats):
+        self.transfers[stats.session_id] = stats
+
+    def finish(self, stats):
+        if self.transfers.pop(stats.session_id, None) is not None:
+            stats.finished = time.monotonic()
+            self.finished.append(stats)
+            self.last_bytes.pop(stats.session_id, None)
+
+    def sample_goodput(self, interval):
+        now = time.monotonic()
+        for session_id, stats in self.transfers.items():
+            elapsed = min(interval, now - stats.started)
+            if elapsed > 0:
+                stats.goodput = (stats.bytes - self.last_bytes.get(session_id, 0)) / elapsed
+            self.last_bytes[session_id] = stats.bytes
+
+    def snapshot(self):
+        now = time.monotonic()
+        names = {value: name.lower() for name, value in vars(Command).items() if name.isupper()}
+        return dict(
+            uptime=round(now - self.started, 3),
+            loop_lag_ms=round(self.loop_lag * 1000, 3),
+            max_loop_lag_ms=round(self.max_loop_lag * 1000, 3),
+            bytes_sent=self.bytes_sent,
+            bytes_received=self.bytes_received,
+            sent={names.get(cmd, str(cmd)): count for cmd, count in enumerate(self.sent) if count},
+            received={names.get(cmd, str(cmd)): count for cmd, count in enumerate(self.received) if count},
+            ack_timeouts=self.ack_timeouts,
+            ack_rtt=self.ack_rtt.snapshot(),
+            transfers=[stats.snapshot(now) for stats in self.transfers.values()],
+            finished=[stats.snapshot(now) for stats in self.finished],
+            chunk_cache=self.chunk_cache.snapshot() if self.chunk_cache is not None else None,
+        )
+
+    def log_summary(self):
+        now = time.monotonic()
+        for stats in self.transfers.values():
+            snapshot = stats.snapshot(now)
+            logger.info("Session %s %s %s: %s of %s bytes, %.1f kB/s, %.1f%% retransmitted, %s duplicates, "
+                        "loop lag %.1f ms", stats.session_id, stats.role, stats.name, stats.bytes, stats.size,
+                        stats.goodput / 1024, snapshot.get('retransmit_ratio', 0) * 100, stats.duplicates,
+                        self.max_loop_lag * 1000)
+        cache = self.chunk_cache
+        if self.transfers and cache is not None and cache.budget:
+            logger.info("Chunk cache: %s files, %s of %s bytes, %s hits, %s misses, %s evictions",
+                        len(cache.files), cache.size, cache.budget, cache.hits, cache.misses, cache.evictions)
+
+    async def run(self, summary_interval=None):
+        loop = asyncio.get_running_loop()
+        last_goodput = last_summary = loop.time()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(self.LAG_INTERVAL)
+            now = loop.time()
+            self.loop_lag = max(0.0, now - before - self.LAG_INTERVAL)
+            self.max_loop_lag = max(self.max_loop_lag, self.loop_lag)
+            if now - last_goodput >= self.GOODPUT_INTERVAL:
+                self.sample_goodput(now - last_goodput)
+                last_goodput = now
+            if summary_interval and now - last_summary >= summary_interval:
+                self.log_summary()
+                self.max_loop_lag = 0.0
+                last_summary = now
+
+
+class StatsProtocol:
+    """
+    Answers any datagram with the node metrics JSON
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(json.dumps(self.metrics.snapshot()).encode(), addr)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
 class WFBNodeProtocol:
 
     def __init__(self, server):
         self.server = server
+        self.version_warned = False
 
     def connection_made(self, transport):
         logging.info('Connection made: %s', transport)
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        # print('data', data[:1])
-        cmd, = struct.unpack('>B', data[:1])
-        message_cls = messages[cmd]
-        message = message_cls.unpack(data)
+        if len(data) < Header.packer.size or data[1] != PROTOCOL_VERSION:
+            if not self.version_warned:
+                logger.warning("Dropping datagrams of another protocol version, peer needs an upgrade")
+                self.version_warned = True
+            return
+        metrics = self.server.metrics
+        metrics.received[data[0]] += 1
+        metrics.bytes_received += len(data)
+        message_cls = messages[data[0]]
+        message = message_cls.unpack(memoryview(data))
         logger.debug("Message received: %s", message)
         self.server.handle_message(message)
 
@@ -167,241 +776,2479 @@ class WFBNodeProtocol:
 
 class WFBNode:
 
-    def __init__(self, inport, outport):
+    DATAGRAM_BUFFER_SIZE = 2048
+    STATS_INTERVAL = 10  # seconds between summaries of running transfers in the log
+
+    def __init__(self, inport, outport, stats_port=None, batch_io=False):
         self.inport = inport
         self.outport = outport
+        self.stats_port = stats_port
+        self.batch_io = batch_io  # sendmmsg/recvmmsg transports where available
+        self.metrics = NodeMetrics()
         self.out_proto = WFBNodeProtocol(self)
         self.in_proto = WFBNodeProtocol(self)
         self.sequence = 1
-        self.session_requests = {}
+        self.ack_events = {}
+        self.send_buffer = bytearray(self.DATAGRAM_BUFFER_SIZE)
+        self.listening = None
 
     def next_sequence(self):
-        self.sequence += 1
+        # wraps around: sequences only match an ACK to its message, they are never ordered
+        self.sequence = self.sequence % MAX_sequence + 1
         return self.sequence
 
     def next_session(self):
         return random.randint(10000, 4294967295)
 
-    async def start(self):
+    async def listen(self):
+        """
+        Open the node sockets once, any number of callers may wait for it
+        """
+        if self.listening is None:
+            self.listening = asyncio.ensure_future(self.open_endpoints())
+        await asyncio.shield(self.listening)
+
+    async def open_endpoints(self):
         loop = asyncio.get_running_loop()
 
-        await loop.create_datagram_endpoint(
+        await udp_batch.create_datagram_endpoint(
             lambda: self.out_proto,
-            remote_addr=('127.0.0.1', self.outport))
+            remote_addr=('127.0.0.1', self.outport),
+            batched=self.batch_io, max_size=self.DATAGRAM_BUFFER_SIZE)
 
-        await loop.create_datagram_endpoint(
+        await udp_batch.create_datagram_endpoint(
             lambda: self.in_proto,
-            local_addr=('127.0.0.1', self.inport))
+            local_addr=('127.0.0.1', self.inport),
+            batched=self.batch_io, max_size=self.DATAGRAM_BUFFER_SIZE)
 
+        if self.stats_port:
+            await loop.create_datagram_endpoint(
+                lambda: StatsProtocol(self.metrics),
+                local_addr=('127.0.0.1', self.stats_port))
+
+        self.metrics_task = asyncio.create_task(self.metrics.run(self.STATS_INTERVAL))
         logging.info("WFBNode started, in: %s, out: %s", self.inport, self.outport)
+
+    async def start(self):
+        await self.listen()
         while True:
             await asyncio.sleep(1)
 
-    def send_message(self, msg):
-        data = msg.pack()
+    def send_message(self, msg, buffer=None):
+        # the transport copies datagrams it can't send right away, the buffer is reused
+        data = msg.pack_into(self.send_buffer if buffer is None else buffer)
         logger.debug("Sending message: %s", msg)
         self.out_proto.send(data)
+        self.metrics.sent[msg.header.cmd] += 1
+        self.metrics.bytes_sent += len(data)
+        return len(data)
+
+    async def send_and_wait_ack(self, msg, rtt=None, timeout=None):
+        """
+        Repeat msg until acked, TimeoutError if no ack comes in `timeout` seconds
+        """
+        if rtt is None:
+            rtt = RttEstimator(self.ACK_TIMEOUT)
+        ack_event = asyncio.Event()
+        self.ack_events[msg.header.sequence] = ack_event
+        started = time.monotonic()
+        tries = 0
+        try:
+            while True:
+                logger.debug('Sending message %s until ack', msg)
+                sent_at = time.monotonic()
+                if timeout is not None and sent_at - started > timeout:
+                    raise TimeoutError("No ack for {}".format(msg))
+                tries += 1
+                self.send_message(msg)
+                self.send_message(msg)
+                try:
+                    await asyncio.wait_for(ack_event.wait(), timeout=rtt.rto)
+                except asyncio.TimeoutError:
+                    rtt.backoff()
+                    self.metrics.ack_timeouts += 1
+                    continue
+                else:
+                    break
+        finally:
+            del self.ack_events[msg.header.sequence]
+        if tries == 1:
+            rtt.sample(time.monotonic() - sent_at)
+            self.metrics.ack_rtt.add(time.monotonic() - sent_at)
+        logger.debug('Message sent, ack received: %s', msg)
 
     def handle_message(self, message):
         raise NotImplemented()
 
 
+class RttEstimator:
+    """
+    Retransmission timeout from measured RTT: SRTT/RTTVAR as in RFC 6298,
+    exponential backoff on timeouts until the next valid sample
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    MIN_RTO = 0.02
+    MAX_RTO = 2.0
+    MAX_BACKOFF = 64
+
+    def __init__(self, initial_rto):
+        self.initial_rto = initial_rto
+        self.srtt = None
+        self.rttvar = None
+        self.backoff_factor = 1
+        self.rto = initial_rto
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.backoff_factor = 1
+        self.update()
+
+    def backoff(self):
+        self.backoff_factor = min(self.backoff_factor * 2, self.MAX_BACKOFF)
+        self.update()
+
+    def update(self):
+        if self.srtt is None:
+            rto = self.initial_rto
+        else:
+            rto = self.srtt + 4 * self.rttvar
+        self.rto = min(max(rto * self.backoff_factor, self.MIN_RTO), self.MAX_RTO)
+
+    def __repr__(self):
+        return 'srtt:{} rttvar:{} rto:{}'.format(self.srtt, self.rttvar, self.rto)
+
+
+class TokenBucket:
+    """
+    Byte rate pacer, rate 0 means unlimited.
+    Sending is allowed while the bucket is not empty, sent bytes are
+    charged afterwards so the bucket may go slightly negative
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def ready(self):
+        if not self.rate:
+            return True
+        self.refill()
+        return self.tokens > 0
+
+    def consume(self, amount):
+        if self.rate:
+            self.tokens -= amount
+
+    def wait_time(self):
+        if not self.rate or self.tokens > 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class RateController:
+    """
+    Loss and delay based sending rate for the pacer.
+    Once per control interval (SRTT): rate doubles until the first congestion
+    signal, then grows by INCREASE while RTT stays close to the minimum seen.
+    Queueing delay - RTT above the base one by more than its usual variation -
+    or a loss ratio above LOSS_TOLERANCE (over at least LOSS_SAMPLES chunks)
+    cut it; radio loss below the tolerance is left to retransmissions and FEC.
+    The server resets it to slow start when it runs out of sessions
+    """
+
+    INCREASE = 1.05
+    LOSS_DECREASE = 0.7
+    DELAY_DECREASE = 0.9
+    LOSS_TOLERANCE = 0.25
+    LOSS_SAMPLES = 32
+    DELAY_THRESHOLD = 1.5  # of base RTT
+    DELAY_MARGIN = 0.005  # least queueing delay taken for congestion
+    DELAY_VARIANCE = 4  # RTTVAR multiple of RTT jitter that is not queueing
+    MIN_RTT_SAMPLE = 0.001  # shorter samples are ACK delay artifacts
+    BASE_RTT_WINDOW = 10  # seconds
+    MIN_INTERVAL = 0.02
+
+    def __init__(self, pacer, max_rate, min_rate):
+        self.pacer = pacer
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.reset()
+
+    def reset(self):
+        self.rate = max(self.min_rate, self.max_rate / 8)
+        self.slow_start = True
+        self.base_rtt = None
+        self.base_rtt_time = 0
+        self.last_rtt = None
+        self.rttvar = 0
+        self.acked = 0
+        self.lost = 0
+        self.last_change = 0
+        self.pacer.rate = self.rate
+
+    def set_rate(self, rate):
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        self.pacer.rate = self.rate
+        logger.debug('Rate: %s', int(self.rate))
+
+    def on_ack(self, count, rtt, srtt, rttvar=0):
+        """
+        `rtt` - sample without the receiver ACK delay, None when there is none
+        """
+        self.acked += count
+        self.rttvar = rttvar or 0
+        if rtt is not None and rtt >= self.MIN_RTT_SAMPLE:
+            now = time.monotonic()
+            if self.base_rtt is None or rtt < self.base_rtt or now - self.base_rtt_time > self.BASE_RTT_WINDOW:
+                self.base_rtt = rtt
+                self.base_rtt_time = now
+            self.last_rtt = rtt
+        self.control(srtt)
+
+    def on_loss(self, count, srtt):
+        self.lost += count
+        self.control(srtt)
+
+    def control(self, srtt):
+        now = time.monotonic()
+        if srtt is None or now - self.last_change < max(srtt, self.MIN_INTERVAL):
+            return
+        samples = self.acked + self.lost
+        if self.lost and samples < self.LOSS_SAMPLES:
+            # too few chunks to tell radio loss from congestion
+            return
+        if self.lost / max(1, samples) > self.LOSS_TOLERANCE:
+            self.slow_start = False
+            self.set_rate(self.rate * self.LOSS_DECREASE)
+        elif self.last_rtt is not None and self.last_rtt > self.base_rtt * self.DELAY_THRESHOLD + max(
+                self.DELAY_MARGIN, self.DELAY_VARIANCE * self.rttvar):
+            self.slow_start = False
+            self.set_rate(self.rate * self.DELAY_DECREASE)
+        elif self.acked and self.slow_start:
+            self.set_rate(self.rate * 2)
+        elif self.acked:
+            self.set_rate(self.rate * self.INCREASE)
+        self.acked = 0
+        self.lost = 0
+        self.last_change = now
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: O(1) schedule, expired entries are collected on advance
+    """
+
+    def __init__(self, tick=0.01, slots=256):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0
+        self.time = time.monotonic()
+        self.size = 0
+
+    def schedule(self, key, token, timeout):
+        deadline = time.monotonic() + timeout
+        ticks = max(1, math.ceil((deadline - self.time) / self.tick))
+        slot = (self.position + min(ticks, len(self.slots) - 1)) % len(self.slots)
+        self.slots[slot].append((deadline, key, token))
+        self.size += 1
+
+    def advance(self, now):
+        expired = []
+        while self.time + self.tick <= now:
+            self.time += self.tick
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            if not slot:
+                continue
+            later = []
+            for entry in slot:
+                if entry[0] <= now:
+                    expired.append((entry[1], entry[2]))
+                else:
+                    later.append(entry)
+            self.slots[self.position] = later
+            self.size -= len(slot) - len(later)
+        return expired
+
+    def clear(self):
+        self.slots = [[] for _ in range(len(self.slots))]
+        self.size = 0
+
+
+class ParityEncoder:
+    """
+    Interleaved XOR parity: every block of k chunks gets m parity chunks,
+    parity j covers block chunks j, j + m, j + 2m...
+    Recovers one lost chunk per parity, i.e. bursts up to m chunks.
+    Blocks not sent in full (resumed downloads) get no parity
+    """
+
+    def __init__(self, k, m, chunk_size):
+        self.k = k
+        self.m = m
+        self.chunk_size = chunk_size
+        self.next_index = 0
+        self.reset(complete=False)
+
+    def reset(self, complete=True):
+        self.count = 0
+        self.complete = complete
+        self.parities = [0] * self.m
+        self.sizes = [0] * self.m
+
+    def add(self, index, data, last=False):
+        """
+        Add chunk (in index order), returns list of parity message fields
+        when the block is complete
+        """
+        if index % self.k == 0:
+            self.reset()
+        elif index != self.next_index:
+            self.reset(complete=False)
+        self.next_index = index + 1
+        j = index % self.k % self.m
+        self.parities[j] ^= int.from_bytes(data, 'little')
+        self.sizes[j] ^= len(data)
+        self.count += 1
+        if (index + 1) % self.k and not last:
+            return []
+        result = []
+        if self.complete:
+            block = index // self.k
+            result = [dict(block=block, parity_no=j, count=self.count, chunk_size=self.chunk_size,
+                           size_xor=self.sizes[j], data=self.parities[j].to_bytes(self.chunk_size, 'little'))
+                      for j in range(min(self.m, self.count))]
+        self.reset(complete=False)
+        return result
+
+
+class ParityDecoder:
+    """
+    Client side of ParityEncoder, keeps the chunks of parity groups that may
+    still recover a lost one. A group is dropped once all its chunks are in
+    `received` (ReceivedChunks of the session), so memory follows the loss,
+    not the file size
+    """
+
+    def __init__(self, k, m):
+        self.k = k
+        self.m = m
+        self.blocks = {}  # block -> ({index: data}, {parity_no: ParityMessage})
+
+    def block_state(self, block):
+        if block not in self.blocks:
+            self.blocks[block] = ({}, {})
+        return self.blocks[block]
+
+    def members(self, block, j, chunks_count):
+        first = block * self.k
+        return range(first + j, min(first + self.k, chunks_count), self.m)
+
+    def complete(self, block, j, received):
+        return all(i in received for i in self.members(block, j, received.chunks_count))
+
+    def drop(self, block, j, received):
+        state = self.blocks.get(block)
+        if state is None:
+            return
+        chunks, parities = state
+        for i in self.members(block, j, received.chunks_count):
+            chunks.pop(i, None)
+        parities.pop(j, None)
+        if not chunks and not parities:
+            del self.blocks[block]
+
+    def add_chunk(self, index, data, received):
+        """
+        Chunk stored in `received` already, returns recovered chunks as recover does
+        """
+        block = index // self.k
+        j = (index - block * self.k) % self.m
+        if self.complete(block, j, received):
+            self.drop(block, j, received)
+            return []
+        chunks, parities = self.block_state(block)
+        chunks[index] = data
+        return self.recover(block, j, received)
+
+    def add_parity(self, msg, received):
+        if self.complete(msg.block, msg.parity_no, received):
+            return []
+        chunks, parities = self.block_state(msg.block)
+        parities[msg.parity_no] = msg
+        return self.recover(msg.block, msg.parity_no, received)
+
+    def recover(self, block, j, received):
+        """
+        Returns [(index, offset, data)] of the chunk rebuilt from parity j, if any
+        """
+        chunks, parities = self.blocks[block]
+        parity = parities.get(j)
+        if parity is None:
+            return []
+        first = block * self.k
+        members = range(first + j, first + parity.count, self.m)
+        missing = [i for i in members if i not in chunks]
+        if len(missing) != 1:
+            return []
+        value = int.from_bytes(parity.data, 'little')
+        size = parity.size_xor
+        for i in members:
+            if i in chunks:
+                value ^= int.from_bytes(chunks[i], 'little')
+                size ^= len(chunks[i])
+        index = missing[0]
+        data = value.to_bytes(parity.chunk_size, 'little')[:size]
+        # the group is complete with the rebuilt chunk
+        self.drop(block, j, received)
+        return [(index, index * parity.chunk_size, data)]
+
+
+class ChunkProducer:
+    """
+    Chunks of the served file read with pread, a file truncated while it is
+    served fails its session with OSError instead of a SIGBUS on a mapping
+    """
+
+    def __init__(self, file_path, chunk_size):
+        self.path = str(file_path)
+        self.chunk_size = chunk_size
+        self.fd = open(file_path, 'rb')
+        stat = os.fstat(self.fd.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.inode = stat.st_ino
+        self.chunks_count = (self.size + chunk_size - 1) // chunk_size
+        if self.size and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def chunk(self, index, buffer=None):
+        """
+        Offset and data of chunk `index`, read into `buffer` when given: the
+        data is then a view valid until the next read into it
+        """
+        offset = index * self.chunk_size
+        size = min(self.chunk_size, self.size - offset)
+        if buffer is None:
+            data = os.pread(self.fd.fileno(), size, offset)
+        else:
+            data = memoryview(buffer)[:size]
+            data = data[:os.preadv(self.fd.fileno(), [data], offset)]
+        if len(data) != size:
+            raise OSError('File {} truncated while served'.format(self.path))
+        return offset, data
+
+    def compress(self, index, codec):
+        """
+        Chunk data and its compressed form, None when it doesn't get smaller,
+        run in the worker pool
+        """
+        data = self.chunk(index)[1]
+        return data, compress_chunk(codec, data)
+
+    def close(self):
+        self.fd.close()
+
+
+class ChunkCache:
+    """
+    LRU of encoded SEND_CHUNK datagrams of recently served files, so files
+    pulled again are not reread, checksummed and compressed for each session.
+    Files are keyed by (path, inode, mtime ns, size, chunk size, codec), a changed file
+    misses and its old chunks age out. Least recently used files are evicted
+    to keep the chunk bytes within `budget`, 0 disables the cache
+    """
+
+    BUDGET = 32 * 1024 * 1024
+
+    def __init__(self, budget=BUDGET):
+        self.budget = budget
+        self.files = collections.OrderedDict()  # key -> [bytes, {chunk index: encoded chunk}]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(producer, codec):
+        return producer.path, producer.inode, producer.mtime, producer.size, producer.chunk_size, codec
+
+    def get(self, key, index):
+        if not self.budget:
+            return None
+        entry = self.files.get(key)
+        encoded = None if entry is None else entry[1].get(index)
+        if encoded is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.files.move_to_end(key)
+        return encoded
+
+    def put(self, key, index, encoded):
+        if not self.budget:
+            return
+        entry = self.files.get(key)
+        if entry is None:
+            entry = self.files[key] = [0, {}]
+        self.files.move_to_end(key)
+        if index in entry[1]:
+            return
+        while self.size + len(encoded) > self.budget and len(self.files) > 1:
+            _, (size, chunks) = self.files.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            logger.debug('Chunk cache evicted %s chunks', len(chunks))
+        if self.size + len(encoded) > self.budget:
+            # the file alone is over the budget, its first chunks stay cached
+            return
+        entry[0] += len(encoded)
+        entry[1][index] = encoded
+        self.size += len(encoded)
+
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return dict(files=len(self.files), bytes=self.size, budget=self.budget, hits=self.hits,
+                    misses=self.misses, hit_ratio=round(self.hits / lookups, 4) if lookups else 0,
+                    evictions=self.evictions)
+
+
+class TransferSession:
+    """
+    Selective repeat sender for one GET_FILE session
+
+    At most `window` chunks are in flight, chunks are read from the file as
+    the window advances, retransmissions are driven by the session timer wheel
+    and by holes reported in the client SACKs.
+    """
+
+    REORDER_THRESHOLD = 3  # chunks sent later and acked before a hole is retransmitted
+    PROBE_CHUNKS = 16
+    PROBE_RATIO = 0.9  # compressed / raw of the probe chunks to keep compression on
+
+    def __init__(self, server, session_id, file_path, window, chunk_size, fec_k=0, fec_m=0, ranges=None,
+                 codec=Codec.NONE, priority=0, weight=1):
+        self.server = server
+        self.session_id = session_id
+        self.file_path = file_path
+        self.window = window
+        self.chunk_size = chunk_size
+        self.producer = ChunkProducer(file_path, chunk_size)
+        self.size = self.producer.size
+        self.chunks_count = self.producer.chunks_count
+        self.buffer = bytearray(server.DATAGRAM_BUFFER_SIZE)
+        if ranges is None:
+            ranges = [(0, self.chunks_count)]
+        ranges = [(start, min(end, self.chunks_count)) for start, end in ranges if start < min(end, self.chunks_count)]
+        self.to_send = sum(end - start for start, end in ranges)
+        self.indexes = itertools.chain.from_iterable(range(start, end) for start, end in ranges)
+        self.sent_count = 0
+        self.acked_count = 0
+        self.inflight = {}  # chunk index -> [message, transmission order, sent at, tries]
+        self.transmissions = 0
+        self.retransmit_queue = collections.deque()
+        self.rtt = RttEstimator(server.ACK_TIMEOUT)
+        self.wheel = TimerWheel(tick=RttEstimator.MIN_RTO / 2)
+        self.wakeup = server.scheduler.wakeup
+        self.last_progress = time.monotonic()
+        self.finished = None
+        self.priority = priority
+        self.weight = max(weight, 1)
+        self.deficit = 0
+        self.parity = None
+        if 0 < fec_m <= fec_k:
+            self.parity = ParityEncoder(fec_k, fec_m, chunk_size)
+        self.codec = codec
+        self.compressing = collections.deque()  # (chunk index, future) compressed ahead of sending
+        self.stats = TransferStats(session_id, file_path.name, 'send', self.size)
+        server.metrics.add(self.stats)
+
+    async def probe_codec(self):
+        """
+        Switch compression off when chunks sampled across the file don't compress
+        """
+        step = max(1, self.chunks_count // self.PROBE_CHUNKS)
+        indexes = range(0, self.chunks_count, step)[:self.PROBE_CHUNKS]
+        loop = asyncio.get_running_loop()
+        ratio = await loop.run_in_executor(
+            self.server.compress_pool,
+            lambda: compression_ratio(self.codec, [self.producer.chunk(index)[1] for index in indexes]))
+        logger.debug('Compression probe: %s, %s', self.session_id, ratio)
+        if ratio > self.PROBE_RATIO:
+            logger.info("File %s is incompressible, sending raw", self.file_path)
+            self.codec = Codec.NONE
+
+    def compress_ahead(self):
+        """
+        Keep a window of chunks compressing in the worker pool, True when the next one is ready
+        """
+        loop = asyncio.get_running_loop()
+        cache = self.server.chunk_cache
+        while len(self.compressing) < self.window:
+            index = next(self.indexes, None)
+            if index is None:
+                break
+            encoded = cache.get(ChunkCache.key(self.producer, self.codec), index)
+            if encoded is not None:
+                self.compressing.append((index, encoded))
+                continue
+            future = loop.run_in_executor(self.server.compress_pool, self.producer.compress, index, self.codec)
+            future.add_done_callback(lambda _: self.wakeup.set())
+            self.compressing.append((index, future))
+        if not self.compressing:
+            return False
+        pending = self.compressing[0][1]
+        return isinstance(pending, bytes) or pending.done()
+
+    @property
+    def done(self):
+        return self.acked_count >= self.to_send
+
+    def on_sack(self, cumulative, bitmap, delay):
+        bits = int.from_bytes(bitmap, 'little')
+        highest_order = 0
+        last_sent_at = None
+        acked = 0
+        stats = self.stats
+        stats.sacks_received += 1
+        for index in list(self.inflight):
+            if index < cumulative or (index > cumulative and (bits >> (index - cumulative - 1)) & 1):
+                msg, order, sent_at, tries = self.inflight.pop(index)
+                acked += 1
+                stats.bytes += msg.size
+                if order != math.inf:
+                    # a chunk queued for retransmit says nothing about what was sent after it
+                    highest_order = max(highest_order, order)
+                if tries == 1 and (last_sent_at is None or sent_at > last_sent_at):
+                    # Karn: ack of a retransmitted chunk is ambiguous
+                    last_sent_at = sent_at
+        if not acked:
+            return
+        self.acked_count += acked
+        rtt = None
+        if last_sent_at is not None:
+            rtt = time.monotonic() - last_sent_at
+            self.rtt.sample(rtt)
+            stats.rtt.add(rtt)
+        rate_control = self.server.rate_control
+        if rate_control is not None:
+            # queueing delay is measured without the receiver ACK delay
+            rate_control.on_ack(acked, None if rtt is None or delay >= rtt else rtt - delay, self.rtt.srtt,
+                                self.rtt.rttvar)
+        holes = 0
+        for index, entry in self.inflight.items():
+            if entry[1] != math.inf and entry[1] + self.REORDER_THRESHOLD <= highest_order:
+                logger.debug('Hole detected: %s, %s', self.session_id, index)
+                entry[1] = math.inf  # queued, ignore until retransmitted
+                self.retransmit_queue.append(index)
+                holes += 1
+        if holes and rate_control is not None:
+            rate_control.on_loss(holes, self.rtt.srtt)
+        self.last_progress = time.monotonic()
+        self.wakeup.set()
+
+    def on_nack(self, ranges):
+        """
+        Chunks the receiver found skipped are resent ahead of new data
+        """
+        lost = 0
+        for index, entry in self.inflight.items():
+            if entry[1] != math.inf and any(start <= index < end for start, end in ranges):
+                logger.debug('Chunk nacked: %s, %s', self.session_id, index)
+                entry[1] = math.inf  # queued, ignore until retransmitted
+                self.retransmit_queue.append(index)
+                lost += 1
+        if not lost:
+            return
+        self.stats.nacked += lost
+        if self.server.rate_control is not None:
+            self.server.rate_control.on_loss(lost, self.rtt.srtt)
+        self.wakeup.set()
+
+    def send_new_chunk(self):
+        cache = self.server.chunk_cache
+        key = ChunkCache.key(self.producer, self.codec)
+        chunk = compressed = encoded = None
+        if self.codec:
+            index, pending = self.compressing.popleft()
+            if isinstance(pending, bytes):
+                encoded = pending
+            else:
+                chunk, compressed = pending.result()
+        else:
+            index = next(self.indexes)
+            encoded = cache.get(key, index)
+        self.sent_count += 1
+        self.stats.chunks_sent += 1
+        offset = index * self.chunk_size
+        if chunk is None and (encoded is None or self.parity is not None):
+            # kept by the inflight message for retransmits, not read into a reused buffer
+            chunk = self.producer.chunk(index)[1]
+        if encoded is not None:
+            msg = SendChunkMessage.from_encoded(self.server.next_sequence(), 0, self.session_id, encoded)
+        else:
+            if compressed is None:
+                data, flags = chunk, 0
+            else:
+                data, flags = compressed, SendChunkMessage.COMPRESSED
+            msg = SendChunkMessage(self.server.next_sequence(), node_id=0, session_id=self.session_id,
+                                   index=index, offset=offset, size=len(chunk), flags=flags,
+                                   crc=zlib.crc32(chunk), data=data)
+            if cache.budget:
+                cache.put(key, index, msg.encode())
+        self.inflight[index] = [msg, 0, 0, 0]
+        sent = self.transmit(index)
+        if self.parity is not None:
+            for fields in self.parity.add(index, chunk, last=index == self.chunks_count - 1):
+                self.stats.parity_sent += 1
+                sent += self.server.send_message(ParityMessage(self.server.next_sequence(), node_id=0,
+                                                               session_id=self.session_id, **fields), self.buffer)
+        return sent
+
+    def transmit(self, index):
+        entry = self.inflight[index]
+        msg = entry[0]
+        self.transmissions += 1
+        entry[1] = self.transmissions
+        entry[2] = time.monotonic()
+        entry[3] += 1
+        if entry[3] > 1:
+            self.stats.retransmits += 1
+        logger.debug('Sending chunk %s, %s', msg.header.sequence, msg.offset)
+        sent = self.server.send_message(msg, self.buffer)
+        self.wheel.schedule(index, self.transmissions, self.rtt.rto)
+        return sent
+
+    def poll_timers(self):
+        expired = 0
+        for index, order in self.wheel.advance(time.monotonic()):
+            entry = self.inflight.get(index)
+            if entry is not None and entry[1] == order:
+                entry[1] = math.inf
+                self.retransmit_queue.append(index)
+                expired += 1
+        if expired:
+            self.stats.timeouts += expired
+            self.rtt.backoff()
+            logger.debug('Retransmission timeout: %s, %s', self.session_id, self.rtt)
+            if self.server.rate_control is not None:
+                # a lost SACK expires many chunks at once, count one loss event
+                self.server.rate_control.on_loss(1, self.rtt.srtt)
+
+    def has_data(self):
+        """
+        Something to send now: a retransmission or a new chunk fitting the window
+        """
+        while self.retransmit_queue and self.retransmit_queue[0] not in self.inflight:
+            self.retransmit_queue.popleft()
+        if self.retransmit_queue:
+            return True
+        return (len(self.inflight) < self.window and self.sent_count < self.to_send
+                and (not self.codec or self.compress_ahead()))
+
+    def send_next(self):
+        """
+        Send one chunk, retransmissions first, returns bytes sent
+        """
+        if self.retransmit_queue:
+            return self.transmit(self.retransmit_queue.popleft())
+        return self.send_new_chunk()
+
+    async def run(self):
+        """
+        Wait until the server scheduler has sent the whole file
+        """
+        self.last_progress = time.monotonic()
+        self.finished = asyncio.get_running_loop().create_future()
+        self.server.scheduler.add(self)
+        try:
+            await self.finished
+        finally:
+            self.server.scheduler.remove(self)
+            self.close()
+
+    def close(self):
+        self.server.metrics.finish(self.stats)
+        for index, pending in self.compressing:
+            if not isinstance(pending, bytes):
+                pending.cancel()
+        self.compressing.clear()
+        self.inflight.clear()
+        self.retransmit_queue.clear()
+        self.wheel.clear()
+        self.producer.close()
+
+
+class MulticastSession:
+    """
+    One to many sender of a file (NORM-like): the first round sends every chunk
+    once, then a FLUSH polls the receivers for NACKs. Repairs of a round are
+    deduplicated across receivers, a parity group where each receiver misses at
+    most one chunk is repaired by one parity datagram instead of the chunks.
+    """
+
+    def __init__(self, server, session_id, file_path, chunk_size, receivers, fec_k=0, fec_m=0,
+                 codec=Codec.NONE, priority=0, weight=1):
+        self.server = server
+        self.session_id = session_id
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.producer = ChunkProducer(file_path, chunk_size)
+        self.size = self.producer.size
+        self.chunks_count = self.producer.chunks_count
+        self.receivers = set(receivers)
+        self.buffer = bytearray(server.DATAGRAM_BUFFER_SIZE)
+        self.chunk_buffer = bytearray(chunk_size)  # chunks are sent before the next one is read
+        self.fec_k = fec_k
+        self.fec_m = fec_m
+        self.parity = None
+        if 0 < fec_m <= fec_k:
+            self.parity = ParityEncoder(fec_k, fec_m, chunk_size)
+        self.codec = codec
+        self.priority = priority
+        self.weight = max(weight, 1)
+        self.deficit = 0
+        self.round = 0
+        self.chunks = collections.deque()  # chunk indexes to send this round
+        self.compressing = collections.deque()  # (chunk index, future) taken from chunks, compressed ahead
+        self.parities = collections.deque()  # (block, parity_no) repairs
+        self.nacks = {}  # node id -> ranges of this round
+        self.nacks_event = asyncio.Event()
+        self.last_progress = time.monotonic()
+        self.finished = None
+        self.sent_chunks = 0
+        self.sent_parities = 0
+        self.stats = TransferStats(session_id, file_path.name, 'multicast', self.size)
+        server.metrics.add(self.stats)
+
+    @property
+    def done(self):
+        return not self.chunks and not self.compressing and not self.parities
+
+    def has_data(self):
+        if self.codec and (self.chunks or self.compressing):
+            return self.compress_ahead()
+        return not self.done
+
+    def compress_ahead(self):
+        """
+        Keep the next chunks of the round compressing in the worker pool, True when the first one is ready
+        """
+        loop = asyncio.get_running_loop()
+        cache = self.server.chunk_cache
+        while self.chunks and len(self.compressing) < self.server.window:
+            index = self.chunks.popleft()
+            encoded = cache.get(ChunkCache.key(self.producer, self.codec), index)
+            if encoded is not None:
+                self.compressing.append((index, encoded))
+                continue
+            future = loop.run_in_executor(self.server.compress_pool, self.producer.compress, index, self.codec)
+            future.add_done_callback(lambda _: self.server.scheduler.wakeup.set())
+            self.compressing.append((index, future))
+        pending = self.compressing[0][1]
+        return isinstance(pending, bytes) or pending.done()
+
+    def poll_timers(self):
+        pass
+
+    def send_next(self):
+        """
+        Send one chunk or repair parity of the round, returns bytes sent
+        """
+        self.last_progress = time.monotonic()
+        if not self.chunks and not self.compressing:
+            block, j = self.parities.popleft()
+            self.sent_parities += 1
+            self.stats.parity_sent += 1
+            return self.send_parity(self.group_parity(block, j))
+        cache = self.server.chunk_cache
+        key = ChunkCache.key(self.producer, self.codec)
+        chunk = compressed = encoded = None
+        if self.codec:
+            index, pending = self.compressing.popleft()
+            if isinstance(pending, bytes):
+                encoded = pending
+            else:
+                chunk, compressed = pending.result()
+        else:
+            index = self.chunks.popleft()
+            encoded = cache.get(key, index)
+        self.sent_chunks += 1
+        if self.round:
+            self.stats.retransmits += 1
+        else:
+            self.stats.chunks_sent += 1
+        offset = index * self.chunk_size
+        if chunk is None and (encoded is None or (self.parity is not None and self.round == 0)):
+            chunk = self.producer.chunk(index, self.chunk_buffer)[1]
+        if encoded is not None:
+            msg = SendChunkMessage.from_encoded(self.server.next_sequence(), 0, self.session_id, encoded)
+        else:
+            if compressed is None:
+                data, flags = chunk, 0
+            else:
+                data, flags = compressed, SendChunkMessage.COMPRESSED
+            msg = SendChunkMessage(self.server.next_sequence(), node_id=0, session_id=self.session_id,
+                                   index=index, offset=offset, size=len(chunk), flags=flags,
+                                   crc=zlib.crc32(chunk), data=data)
+            if cache.budget:
+                cache.put(key, index, msg.encode())
+        sent = self.server.send_message(msg, self.buffer)
+        if self.parity is not None and self.round == 0:
+            for fields in self.parity.add(index, chunk, last=index == self.chunks_count - 1):
+                self.stats.parity_sent += 1
+                sent += self.send_parity(fields)
+        return sent
+
+    def send_parity(self, fields):
+        return self.server.send_message(ParityMessage(self.server.next_sequence(), node_id=0,
+                                                      session_id=self.session_id, **fields), self.buffer)
+
+    def group_parity(self, block, j):
+        """
+        Fields of parity j of `block`, same as the ParityEncoder one
+        """
+        first = block * self.fec_k
+        count = min(self.fec_k, self.chunks_count - first)
+        value = 0
+        size_xor = 0
+        for index in range(first + j, first + count, self.fec_m):
+            chunk = self.producer.chunk(index, self.chunk_buffer)[1]
+            value ^= int.from_bytes(chunk, 'little')
+            size_xor ^= len(chunk)
+        return dict(block=block, parity_no=j, count=count, chunk_size=self.chunk_size, size_xor=size_xor,
+                    data=value.to_bytes(self.chunk_size, 'little'))
+
+    def on_nack(self, node_id, round_no, ranges):
+        if round_no != self.round or node_id not in self.receivers:
+            return
+        self.nacks[node_id] = ranges
+        if set(self.nacks) >= self.receivers:
+            self.nacks_event.set()
+
+    def plan_repairs(self):
+        """
+        Union of the chunks missed by the receivers, as parities where one is enough
+        """
+        missing = {node: set(itertools.chain.from_iterable(itertools.starmap(range, ranges)))
+                   for node, ranges in self.nacks.items()}
+        wanted = set().union(*missing.values())
+        self.stats.bytes = min(self.size, (self.chunks_count - len(wanted)) * self.chunk_size)
+        chunks = set()
+        if self.parity is None:
+            chunks = wanted
+        else:
+            groups = collections.defaultdict(list)  # (block, parity_no) -> indexes
+            for index in wanted:
+                block = index // self.fec_k
+                groups[block, (index - block * self.fec_k) % self.fec_m].append(index)
+            for group, indexes in groups.items():
+                if all(len(lost.intersection(indexes)) <= 1 for lost in missing.values()):
+                    self.parities.append(group)
+                else:
+                    chunks.update(indexes)
+        self.chunks.extend(sorted(chunks))
+        logger.info("Multicast %s round %s: %s receivers, %s chunks and %s parities to repair", self.session_id,
+                    self.round, len(self.nacks), len(chunks), len(self.parities))
+
+    async def send_round(self):
+        """
+        Wait until the server scheduler has sent the chunks of the round
+        """
+        self.last_progress = time.monotonic()
+        self.finished = asyncio.get_running_loop().create_future()
+        rate_control = self.server.rate_control
+        if rate_control is not None:
+            # no per chunk feedback from receivers to probe the rate, the max one is safe for the link
+            rate_control.set_rate(rate_control.max_rate)
+        self.server.scheduler.add(self)
+        try:
+            await self.finished
+        finally:
+            self.server.scheduler.remove(self)
+
+    async def poll(self):
+        """
+        FLUSH until every receiver sent its NACK, silent ones are dropped
+        """
+        self.nacks = {}
+        self.nacks_event.clear()
+        msg = FlushMessage(self.server.next_sequence(), node_id=0, session_id=self.session_id, round=self.round)
+        rtt = RttEstimator(self.server.ACK_TIMEOUT)
+        started = time.monotonic()
+        while not self.nacks_event.is_set() and time.monotonic() - started < self.server.SEND_FILE_TIMEOUT:
+            self.server.send_message(msg)
+            try:
+                await asyncio.wait_for(self.nacks_event.wait(), timeout=rtt.rto)
+            except asyncio.TimeoutError:
+                rtt.backoff()
+        silent = self.receivers - set(self.nacks)
+        if silent:
+            logger.info("Multicast %s receivers dropped: %s", self.session_id, sorted(silent))
+            self.receivers -= silent
+
+    async def run(self):
+        """
+        Rounds of sending and repairs until all receivers have the file
+        """
+        self.chunks.extend(range(self.chunks_count))
+        while self.receivers:
+            await self.send_round()
+            await self.poll()
+            self.round += 1
+            self.plan_repairs()
+            if self.done:
+                break
+        logger.info("Multicast %s: %s rounds, %s chunks and %s parities sent for %s chunks", self.session_id,
+                    self.round, self.sent_chunks, self.sent_parities, self.chunks_count)
+
+    def close(self):
+        self.server.metrics.finish(self.stats)
+        for index, pending in self.compressing:
+            if not isinstance(pending, bytes):
+                pending.cancel()
+        self.compressing.clear()
+        self.chunks.clear()
+        self.parities.clear()
+        self.producer.close()
+
+
+class RadioLink:
+    """
+    wfb link the server sends over: datagrams up to `mtu` bytes, wfb_tx groups
+    them in FEC blocks of fec_k datagrams (plus fec_n - fec_k parity), sent
+    once the block is full, so chunks fill the MTU and bursts are whole blocks
+    """
+
+    MTU = 1446  # wfb_tx radio MTU
+    FEC_K = 8
+    FEC_N = 12
+    PROBE_SIZES = (1446, 1400, 1280, 1024, 576)
+
+    def __init__(self, mtu=MTU, fec_k=FEC_K, fec_n=FEC_N):
+        self.mtu = mtu
+        self.fec_k = fec_k
+        self.fec_n = fec_n
+
+    def chunk_size(self, mtu=None):
+        """
+        Largest chunk whose SEND_CHUNK and PARITY datagrams fit the MTU
+        """
+        return (mtu or self.mtu) - max(SendChunkMessage.data_start, ParityMessage.data_start)
+
+    def list_entries_size(self, mtu=None):
+        """
+        Space for the entries of a LIST_PAGE datagram
+        """
+        return (mtu or self.mtu) - ListPageMessage.entries_start
+
+    def max_ranges(self, message_class, mtu=None):
+        """
+        Chunk ranges a RESUME_FILE or NACK datagram carries
+        """
+        return ((mtu or self.mtu) - message_class.ranges_start) // message_class.range_packer.size
+
+    def max_signatures(self, mtu=None):
+        """
+        Block signatures a SIGNATURES datagram carries
+        """
+        return ((mtu or self.mtu) - SignaturesMessage.signatures_start) // SignaturesMessage.signature_packer.size
+
+    def max_runs(self, mtu=None):
+        """
+        Copy runs a DELTA_MATCHES datagram carries
+        """
+        return ((mtu or self.mtu) - DeltaMatchesMessage.runs_start) // DeltaMatchesMessage.run_packer.size
+
+    def burst(self, datagrams):
+        """
+        At least `datagrams`, rounded up to whole FEC blocks
+        """
+        return self.fec_k * max(1, -(-datagrams // self.fec_k))
+
+    def probe_sizes(self):
+        return [self.mtu] + [size for size in self.PROBE_SIZES if size < self.mtu]
+
+
+class SessionScheduler:
+    """
+    Interleaves chunks of all transfer sessions under the server pacer:
+    strict priority between levels (higher first), deficit round robin
+    by session weight within a level. Sessions without progress for
+    `stale_timeout` are failed and reclaimed.
+    """
+
+    TICK = RttEstimator.MIN_RTO / 2
+
+    def __init__(self, pacer, quantum, stale_timeout, burst=1, on_idle=None):
+        self.pacer = pacer
+        self.quantum = quantum  # bytes per round per weight unit, not less than a datagram
+        self.stale_timeout = stale_timeout
+        self.burst = burst  # datagrams sent back to back, a whole wfb_tx FEC block
+        self.on_idle = on_idle  # called when the last session is gone
+        self.levels = {}  # priority -> deque of sessions
+        self.wakeup = asyncio.Event()
+
+    def add(self, session):
+        session.deficit = 0
+        self.levels.setdefault(session.priority, collections.deque()).append(session)
+        self.wakeup.set()
+
+    def remove(self, session):
+        queue = self.levels.get(session.priority)
+        if queue is not None and session in queue:
+            queue.remove(session)
+            if not queue:
+                del self.levels[session.priority]
+
+    def sessions(self):
+        return [session for queue in self.levels.values() for session in queue]
+
+    def pick(self):
+        for priority in sorted(self.levels, reverse=True):
+            queue = self.levels[priority]
+            for _ in range(2 * len(queue)):
+                session = queue[0]
+                if not session.has_data():
+                    session.deficit = 0
+                elif session.deficit > 0:
+                    return session
+                else:
+                    session.deficit += self.quantum * session.weight
+                queue.rotate(-1)
+        return None
+
+    def check(self, now):
+        for session in self.sessions():
+            session.poll_timers()
+            if session.finished.done():
+                continue
+            if session.done:
+                self.remove(session)
+                session.finished.set_result(None)
+            elif now - session.last_progress > self.stale_timeout:
+                self.remove(session)
+                session.finished.set_exception(TimeoutError("File transfer timeout"))
+
+    def send_burst(self):
+        """
+        Up to `burst` datagrams, the pacer goes into debt to finish the FEC block,
+        returns the number sent
+        """
+        for count in range(self.burst):
+            session = self.pick()
+            if session is None:
+                return count
+            try:
+                session.deficit -= session.send_next()
+            except OSError as e:
+                # the served file can't be read anymore
+                self.remove(session)
+                session.finished.set_exception(e)
+        return self.burst
+
+    async def run(self):
+        while True:
+            self.check(time.monotonic())
+            while self.pacer.ready() and self.send_burst() == self.burst:
+                pass
+            self.wakeup.clear()
+            if not self.levels:
+                if self.on_idle is not None:
+                    self.on_idle()
+                await self.wakeup.wait()
+                continue
+            timeout = min(self.TICK, self.pacer.wait_time() or self.TICK)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def file_digest(path, digest_size=ListPageMessage.DIGEST_SIZE):
+    digest = hashlib.blake2b(digest_size=digest_size)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            digest.update(data)
+    return digest.digest()
+
+
+class DirectoryIndex:
+    """
+    Files of the served directory sorted by name: name -> [size, mtime, digest, stamp],
+    refreshes compare the (size, mtime ns, inode) stamp so unchanged files keep
+    their cached digest.
+    Pages are sized to the MTU of `link`
+    """
+
+    def __init__(self, root_dir, link):
+        self.root_dir = root_dir
+        self.link = link
+        self.entries = {}
+        self.names = []
+        self.generation = 0
+
+    def refresh(self):
+        seen = set()
+        changed = False
+        with os.scandir(self.root_dir) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                name = entry.name.encode()
+                seen.add(name)
+                cached = self.entries.get(name)
+                stamp = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                if cached is None or cached[3] != stamp:
+                    self.entries[name] = [stat.st_size, int(stat.st_mtime), None, stamp]
+                    changed = True
+        for name in set(self.entries) - seen:
+            del self.entries[name]
+            changed = True
+        if changed or not self.generation:
+            self.names = sorted(self.entries)
+            self.generation += 1
+            logger.debug('Directory index refreshed: %s files, generation %s', len(self.names), self.generation)
+
+    def page(self, first, flags):
+        """
+        Names from `first` on fitting one LIST_PAGE datagram
+        """
+        names = []
+        space = self.link.list_entries_size()
+        for name in itertools.islice(self.names, first, None):
+            space -= ListPageMessage.entry_size(name, flags)
+            if space < 0:
+                break
+            names.append(name)
+        return names
+
+
 class FtpServer(WFBNode):
 
     ACK_TIMEOUT = 0.05
     SEND_FILE_TIMEOUT = 10
-    CHUNK_SIZE = 1224
-
-    def __init__(self, inport, outport, root_dir):
-        super().__init__(inport, outport)
+    WINDOW_SIZE = 64
+    MAX_RATE = 512 * 1024  # bytes/s, must stay below the radio link capacity
+    MIN_RATE = 4 * 1024
+    PACER_BURST = 8  # datagrams, rounded up to whole FEC blocks, wfb_tx queue is ~200 datagrams
+    PROBE_TIMEOUT = 0.5
+    ANNOUNCE_TIME = 2  # seconds receivers have to join a multicast session when they are not listed
+    COMPRESS_WORKERS = 2
+    DELTA_MAX_SIZE = 16 * 1024 * 1024  # bytes, the rolling checksum does ~1 MB/s where blocks don't match
+    SESSION_LINGER = 60
+
+    def __init__(self, inport, outport, root_dir, window=WINDOW_SIZE, max_rate=MAX_RATE, rate_control=True,
+                 link=None, probe_mtu=False, stats_port=None, batch_io=False, cache_size=ChunkCache.BUDGET):
+        super().__init__(inport, outport, stats_port, batch_io)
         self.root_dir = pathlib.Path(root_dir)
-        self.ack_events = {}
-        self.nack_events = {}
+        self.window = window
+        self.link = link or RadioLink()
+        self.probe_mtu = probe_mtu
+        burst = self.link.burst(self.PACER_BURST)
+        self.pacer = TokenBucket(max_rate, burst * self.link.mtu)
+        self.rate_control = None
+        if max_rate and rate_control:
+            self.rate_control = RateController(self.pacer, max_rate, self.MIN_RATE)
         self.sessions = {}
+        self.missing_sessions = set()  # sessions of requested files not found, repeated requests get a NAK again
+        self.multicast_sessions = {}
+        self.ack_nodes = {}  # sequence -> node ids acked a multicast message
+        self.index = DirectoryIndex(self.root_dir, self.link)
+        self.delta_signatures = {}
+        self.delta_updated = {}
+        self.compress_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.COMPRESS_WORKERS)
+        self.delta_pool = None  # worker process, started by the first delta request
+        self.chunk_cache = ChunkCache(cache_size)
+        self.metrics.chunk_cache = self.chunk_cache
+        self.scheduler = SessionScheduler(self.pacer, self.DATAGRAM_BUFFER_SIZE, self.SEND_FILE_TIMEOUT,
+                                          burst=self.link.fec_k,
+                                          on_idle=self.rate_control.reset if self.rate_control else None)
+
+    async def start(self):
+        self.scheduler_task = asyncio.create_task(self.scheduler.run())
+        await super().start()
+
+    def send_message(self, msg, buffer=None):
+        size = super().send_message(msg, buffer)
+        self.pacer.consume(size)
+        return size
 
     def handle_message(self, message):
         if message.header.cmd == Command.GET_LIST:
-            self.do_list()
+            asyncio.create_task(self.do_list(message))
         elif message.header.cmd == Command.ACK:
             logger.debug('Ack received %s', message.ack_sequence)
             if message.ack_sequence in self.ack_events:
                 self.ack_events[message.ack_sequence].set()
-        elif message.header.cmd == Command.GET_FILE:
+            if message.ack_sequence in self.ack_nodes:
+                self.ack_nodes[message.ack_sequence].add(message.header.node_id)
+        elif message.header.cmd == Command.NACK:
+            session = self.multicast_sessions.get(message.session_id)
+            if session is not None:
+                session.on_nack(message.header.node_id, message.round, message.ranges)
+            else:
+                session = self.sessions.get(message.session_id)
+                if session is not None:
+                    session.on_nack(message.ranges)
+        elif message.header.cmd == Command.SACK:
+            logger.debug('Sack received %s, %s', message.session_id, message.cumulative)
+            session = self.sessions.get(message.session_id)
+            if session is not None:
+                session.on_sack(message.cumulative, message.bitmap, message.delay * SackMessage.DELAY_UNIT)
+        elif message.header.cmd == Command.SIGNATURES:
+            if message.session_id not in self.sessions:
+                if message.session_id not in self.delta_signatures:
+                    asyncio.get_running_loop().call_later(self.SEND_FILE_TIMEOUT, self.reclaim_signatures,
+                                                          message.session_id)
+                self.delta_signatures.setdefault(message.session_id, {})[message.first_block] = message.signatures
+                self.delta_updated[message.session_id] = time.monotonic()
+            ack = AckMessage(self.next_sequence(), node_id=0, ack_sequence=message.header.sequence, ack=True)
+            self.send_message(ack)
+        elif message.header.cmd in (Command.GET_FILE, Command.RESUME_FILE, Command.DELTA_FILE):
             asyncio.create_task(self.do_get_file(message))
 
-    # def do_list(self):
-    #     for p in self.root_dir.glob("*"):
-    #         asyncio.create_task(self.do_send_list_item(p.name))
-
-    # async def do_send_list_item(self, item):
-    #     ack_event = asyncio.Event()
-    #     sequence = self.next_sequence()
-    #     self.ack_events[sequence] = ack_event
-    #     while True:
-    #         msg = SendListItemMessage(...)
-    #         self.send_message(msg)
-    #         try:
-    #             await asyncio.wait_for(ack_event.wait(), timeout=self.ACK_TIMEOUT)
-    #         except asyncio.TimeoutError:
-    #             continue
-    #         else:
-    #             break
-    #     del self.ack_event[sequence]
+    async def do_list(self, message):
+        """
+        Send up to message.pages index pages, the index is refreshed when a listing starts
+        """
+        if message.first == 0:
+            self.index.refresh()
+        generation = self.index.generation
+        first = message.first
+        for page_no in range(max(message.pages, 1)):
+            names = self.index.page(first, message.flags)
+            if message.flags & GetListMessage.HASHES:
+                missing = [name for name in names if self.index.entries[name][2] is None]
+                if missing:
+                    loop = asyncio.get_running_loop()
+                    digests = await loop.run_in_executor(
+                        None, lambda: [file_digest(os.path.join(self.root_dir, name.decode())) for name in missing])
+                    if self.index.generation != generation:
+                        return
+                    for name, digest in zip(missing, digests):
+                        self.index.entries[name][2] = digest
+            last = page_no == message.pages - 1 or first + len(names) >= len(self.index.names)
+            msg = ListPageMessage(self.next_sequence(), node_id=0, request_id=message.request_id,
+                                  generation=generation, first=first, total=len(self.index.names),
+                                  flags=message.flags, last=last,
+                                  entries=[(name, *self.index.entries[name][:3]) for name in names])
+            self.send_message(msg)
+            first += len(names)
+            if last:
+                break
 
     async def do_get_file(self, message):
+        if message.session_id in self.missing_sessions:
+            # our negative ack was lost
+            self.send_missing(message)
+            return
         if message.session_id in self.sessions:
             logger.info('Session %s already opened', message.session_id)
             return
-        self.sessions[message.session_id] = True
+        self.sessions[message.session_id] = None
+        try:
+            await self.send_file(message)
+        except OSError as e:
+            logger.info("Session %s dropped: %s", message.session_id, e)
+        finally:
+            session = self.sessions.get(message.session_id)
+            if session is not None:
+                session.close()
+            # remember the id for a while, repeated requests of a finished session are ignored
+            self.sessions[message.session_id] = None
+            asyncio.get_running_loop().call_later(self.SESSION_LINGER, self.forget_session, message.session_id)
+
+    def forget_session(self, session_id):
+        self.sessions.pop(session_id, None)
+        self.missing_sessions.discard(session_id)
+
+    def send_missing(self, message):
+        msg = AckMessage(self.next_sequence(), node_id=0, ack_sequence=message.header.sequence, ack=False)
+        self.send_message(msg)
+
+    async def send_file(self, message):
         name = message.name.decode().strip('\x00')
         file_path = self.root_dir / name
         # import pdb; pdb.set_trace()
         if not file_path.exists():
             logger.info("File not exists: %s", file_path)
-            # FIXME!!!
-            msg = AckMessage(self.next_sequence(), node_id=0, ack_sequence=message.header.sequence, ack=False)
-            self.send_message(msg)
+            self.delta_signatures.pop(message.session_id, None)
+            self.delta_updated.pop(message.session_id, None)
+            self.missing_sessions.add(message.session_id)
+            self.send_missing(message)
             return
         start_time = time.monotonic()
-        with open(file_path, 'rb') as f:
-            tasks = []
-            offset = 0
-            while True:
-                chunk = f.read(self.CHUNK_SIZE)
-                if chunk:
-                    tasks.append(asyncio.create_task(self.send_chunk(message.session_id, offset, chunk)))
-                    offset += self.CHUNK_SIZE
-                else:
-                    break
-        done, pending = await asyncio.wait(tasks, timeout=self.SEND_FILE_TIMEOUT)
-
-        if pending:
-            for t in pending:
-                t.cancel()
-            raise TimeoutError("File transfer timeout")
-        else:
-            fin_msg = TransferCompleteMessage(self.next_sequence(), node_id=0, session_id=message.session_id)
-            await self.send_and_wait_ack(fin_msg)
-            transfer_time = time.monotonic() - start_time
-            logger.info("File %s trasnsfered is %ss", file_path, transfer_time)
-
-    async def send_chunk(self, session_id, offset, chunk):
-        ack_event = asyncio.Event()
-        sequence = self.next_sequence()
-        self.ack_events[sequence] = ack_event
-        msg = SendChunkMessage(sequence, node_id=0, session_id=session_id,
-                               offset=offset, size=len(chunk), data=chunk)
-        while True:
-            logger.debug('Sending chunk %s, %s', sequence, offset)
+        mtu = self.link.mtu
+        if self.probe_mtu and message.header.cmd != Command.RESUME_FILE:
+            mtu = await self.probe_link(message.session_id)
+        chunk_size = self.link.chunk_size(mtu)
+        ranges = None
+        runs = None
+        if message.header.cmd == Command.DELTA_FILE:
+            runs = await self.find_delta(message, file_path)
+            if runs is not None:
+                stat = file_path.stat()
+                covered = covered_chunks(runs, message.block_size, stat.st_size, stat.st_mtime_ns, chunk_size)
+                ranges = covered.missing_ranges(covered.chunks_count)
+        elif message.header.cmd == Command.RESUME_FILE:
+            stat = file_path.stat()
+            if (message.size, message.mtime) != (stat.st_size, stat.st_mtime_ns):
+                logger.info("File %s changed since partial download, sending it all", file_path)
+            elif not 0 < message.chunk_size <= self.link.chunk_size():
+                logger.info("Bad resume chunk size %s, sending it all", message.chunk_size)
+            else:
+                chunk_size = message.chunk_size
+                ranges = message.ranges
+        codec = message.codec if Codec.available(message.codec) else Codec.NONE
+        loop = asyncio.get_running_loop()
+        digest = loop.run_in_executor(None, file_digest, str(file_path), TransferCompleteMessage.DIGEST_SIZE)
+        session = TransferSession(self, message.session_id, file_path, self.window, chunk_size,
+                                  fec_k=message.fec_k, fec_m=message.fec_m, ranges=ranges, codec=codec,
+                                  priority=message.priority, weight=message.weight)
+        self.sessions[message.session_id] = session
+        if session.codec:
+            await session.probe_codec()
+        if runs is not None:
+            max_runs = self.link.max_runs(mtu)
+            for batch, first in enumerate(range(0, max(len(runs), 1), max_runs)):
+                matches_msg = DeltaMatchesMessage(self.next_sequence(), node_id=0, session_id=message.session_id,
+                                                  batch=batch, runs=runs[first:first + max_runs])
+                await self.send_and_wait_ack(matches_msg, session.rtt, self.SEND_FILE_TIMEOUT)
+        info_msg = FileInfoMessage(self.next_sequence(), node_id=0, session_id=message.session_id,
+                                   size=session.size, mtime=session.producer.mtime, chunk_size=chunk_size,
+                                   resumed=ranges is not None, codec=session.codec)
+        await self.send_and_wait_ack(info_msg, session.rtt, self.SEND_FILE_TIMEOUT)
+        if runs is not None:
+            logger.info("Delta of %s: %s copy runs, %s of %s chunks to send", file_path, len(runs),
+                        session.to_send, session.chunks_count)
+        elif ranges is not None:
+            logger.info("Resuming %s: %s of %s chunks", file_path, session.to_send, session.chunks_count)
+        await session.run()
+
+        fin_msg = TransferCompleteMessage(self.next_sequence(), node_id=0, session_id=message.session_id,
+                                          digest=await digest)
+        await self.send_and_wait_ack(fin_msg, session.rtt, self.SEND_FILE_TIMEOUT)
+        transfer_time = time.monotonic() - start_time
+        logger.info("File %s trasnsfered is %ss", file_path, transfer_time)
+
+    async def push_file(self, name, receivers=None, fec_k=0, fec_m=0, codec=Codec.NONE, priority=0, weight=1):
+        """
+        Send `name` once to all ground stations listening on the link, returns
+        the node ids that got it. `receivers` are the node ids to wait for,
+        by default whoever joins within ANNOUNCE_TIME
+        """
+        file_path = self.root_dir / name
+        start_time = time.monotonic()
+        session_id = self.next_session()
+        codec = codec if Codec.available(codec) else Codec.NONE
+        stat = file_path.stat()
+        loop = asyncio.get_running_loop()
+        digest = loop.run_in_executor(None, file_digest, str(file_path), TransferCompleteMessage.DIGEST_SIZE)
+        announce_msg = AnnounceMessage(self.next_sequence(), node_id=0, session_id=session_id, size=stat.st_size,
+                                       mtime=stat.st_mtime_ns, chunk_size=self.link.chunk_size(), fec_k=fec_k,
+                                       fec_m=fec_m, codec=codec, name=name.encode())
+        timeout = self.ANNOUNCE_TIME if receivers is None else self.SEND_FILE_TIMEOUT
+        joined = await self.send_and_wait_nodes(announce_msg, receivers, timeout)
+        if not joined:
+            raise TimeoutError("No receivers joined {}".format(name))
+        logger.info("Multicast %s of %s to receivers %s", session_id, file_path, sorted(joined))
+        session = MulticastSession(self, session_id, file_path, announce_msg.chunk_size, joined, fec_k=fec_k,
+                                   fec_m=fec_m, codec=codec, priority=priority, weight=weight)
+        self.multicast_sessions[session_id] = session
+        try:
+            await session.run()
+            fin_msg = TransferCompleteMessage(self.next_sequence(), node_id=0, session_id=session_id,
+                                              digest=await digest)
+            done = await self.send_and_wait_nodes(fin_msg, session.receivers, self.SEND_FILE_TIMEOUT)
+        finally:
+            session.close()
+            del self.multicast_sessions[session_id]
+        logger.info("File %s multicast to %s in %ss", file_path, sorted(done), time.monotonic() - start_time)
+        return done
+
+    async def send_and_wait_nodes(self, msg, nodes, timeout):
+        """
+        Repeat msg until all `nodes` acked it or for `timeout` seconds when
+        nodes is None, returns the node ids that acked
+        """
+        rtt = RttEstimator(self.ACK_TIMEOUT)
+        acked = self.ack_nodes[msg.header.sequence] = set()
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline and (nodes is None or not acked >= set(nodes)):
+                self.send_message(msg)
+                await asyncio.sleep(min(rtt.rto, deadline - time.monotonic()))
+                rtt.backoff()
+        finally:
+            del self.ack_nodes[msg.header.sequence]
+        return acked if nodes is None else acked & set(nodes)
+
+    async def probe_link(self, session_id):
+        """
+        Largest datagram size reaching the client, the configured MTU if no probe is acked
+        """
+        events = {}
+        for size in self.link.probe_sizes():
+            msg = ProbeMessage(self.next_sequence(), node_id=0, session_id=session_id, size=size)
+            events[size] = self.ack_events[msg.header.sequence] = asyncio.Event()
             self.send_message(msg)
-            #self.send_message(msg)
-            try:
-                await asyncio.wait_for(ack_event.wait(), timeout=self.ACK_TIMEOUT)
-            except asyncio.TimeoutError:
+            self.send_message(msg)
+        largest = self.link.mtu
+        try:
+            await asyncio.wait_for(events[largest].wait(), timeout=self.PROBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for sequence in [seq for seq, event in self.ack_events.items() if event in events.values()]:
+                del self.ack_events[sequence]
+        acked = [size for size, event in events.items() if event.is_set()]
+        mtu = max(acked) if acked else largest
+        logger.info("Session %s link MTU: %s", session_id, mtu)
+        return mtu
+
+    def reclaim_signatures(self, session_id):
+        """
+        Drop signatures of a delta request that never came
+        """
+        if session_id not in self.delta_signatures:
+            return
+        idle = time.monotonic() - self.delta_updated[session_id]
+        if idle < self.SEND_FILE_TIMEOUT:
+            asyncio.get_running_loop().call_later(self.SEND_FILE_TIMEOUT - idle, self.reclaim_signatures, session_id)
+            return
+        logger.info("Signatures of session %s dropped", session_id)
+        del self.delta_signatures[session_id]
+        del self.delta_updated[session_id]
+
+    async def find_delta(self, message, file_path):
+        batches = self.delta_signatures.pop(message.session_id, {})
+        self.delta_updated.pop(message.session_id, None)
+        signatures = [signature for first in sorted(batches) for signature in batches[first]]
+        if len(signatures) != message.blocks_count or message.block_size == 0:
+            logger.info("Incomplete signatures for %s: %s of %s, sending it all",
+                        file_path, len(signatures), message.blocks_count)
+            return None
+        if file_path.stat().st_size > self.DELTA_MAX_SIZE:
+            logger.info("File %s is too large for delta, sending it all", file_path)
+            return None
+        if self.delta_pool is None:
+            # the per byte rolling checksum holds the GIL, a thread would slow the loop down.
+            # spawned, a forked worker would keep the node sockets open
+            self.delta_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.delta_pool, compute_delta, str(file_path), message.block_size,
+                                              signatures)
+        except concurrent.futures.BrokenExecutor as e:
+            logger.error("Delta worker failed: %s, sending %s all", e, file_path)
+            self.delta_pool = None
+            return None
+
+
+def merge_ranges(ranges, max_ranges):
+    """
+    Sorted [start, end) ranges, the smallest gaps between them are merged to fit max_ranges
+    """
+    if len(ranges) <= max_ranges:
+        return ranges
+    gaps = sorted(range(1, len(ranges)), key=lambda i: ranges[i][0] - ranges[i - 1][1])
+    cuts = sorted(gaps[len(gaps) - max_ranges + 1:])
+    merged = []
+    first = 0
+    for cut in cuts + [len(ranges)]:
+        merged.append((ranges[first][0], ranges[cut - 1][1]))
+        first = cut
+    return merged
+
+
+class ChunkBitmap:
+    """
+    One bit per chunk of a partial download, persisted in a sidecar file
+    """
+
+    header = struct.Struct('>QQH')  # size, mtime ns, chunk size
+
+    def __init__(self, size, mtime, chunk_size):
+        self.size = size
+        self.mtime = mtime
+        self.chunk_size = chunk_size
+        self.chunks_count = (size + chunk_size - 1) // chunk_size
+        self.bits = bytearray((self.chunks_count + 7) // 8)
+
+    def set(self, index):
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, index):
+        return (self.bits[index >> 3] >> (index & 7)) & 1 == 1
+
+    def copy(self):
+        bitmap = ChunkBitmap(self.size, self.mtime, self.chunk_size)
+        bitmap.bits[:] = self.bits
+        return bitmap
+
+    def missing_ranges(self, max_ranges):
+        """
+        [start, end) ranges of missing chunks, the smallest gaps between
+        ranges are merged to fit max_ranges
+        """
+        ranges = []
+        start = None
+        for byte_no, byte in enumerate(self.bits):
+            if byte == 0xff and start is None:
+                continue
+            if byte == 0 and start is not None:
                 continue
+            for index in range(byte_no * 8, min(byte_no * 8 + 8, self.chunks_count)):
+                if index in self:
+                    if start is not None:
+                        ranges.append((start, index))
+                        start = None
+                elif start is None:
+                    start = index
+        if start is not None:
+            ranges.append((start, self.chunks_count))
+        return merge_ranges(ranges, max_ranges)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.size, self.mtime, self.chunk_size))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        bitmap = cls(*cls.header.unpack_from(data))
+        bits = data[cls.header.size:]
+        if len(bits) != len(bitmap.bits):
+            raise ValueError('Broken chunk bitmap {}'.format(path))
+        bitmap.bits[:] = bits
+        return bitmap
+
+
+def block_signatures(path, block_size):
+    """
+    (weak, strong) signatures of all full blocks of a local file
+    """
+    signatures = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break
+            signatures.append((zlib.adler32(block), hashlib.blake2b(block, digest_size=8).digest()))
+    return signatures
+
+
+def compute_delta(path, block_size, signatures, window=1 << 20):
+    """
+    Find blocks of a remote copy in the file with a rolling adler32,
+    returns runs (offset, block, count) of matching blocks.
+    The file is read with pread `window` bytes at a time, matching stops
+    where it was truncated
+    """
+    blocks = {}
+    for block, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, block)
+    runs = []
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        if size < block_size or not blocks:
+            return runs
+        window = max(window, 2 * block_size + 1)
+        data = b''
+        base = 0  # file offset of data
+        pos = 0
+        weak = None
+        while pos + block_size <= size:
+            if pos + block_size >= base + len(data):
+                # the block and the byte rolled in after it
+                data = os.pread(fd, min(window, size - pos), pos)
+                base = pos
+                if pos + block_size > base + len(data):
+                    break
+            i = pos - base
+            if weak is None:
+                weak = zlib.adler32(data[i:i + block_size])
+                a, b = weak & 0xffff, weak >> 16
+            candidates = blocks.get(weak)
+            if candidates is not None:
+                block = candidates.get(hashlib.blake2b(data[i:i + block_size], digest_size=8).digest())
+                if block is not None:
+                    if runs and runs[-1][0] + runs[-1][2] * block_size == pos and runs[-1][1] + runs[-1][2] == block:
+                        runs[-1][2] += 1
+                    else:
+                        runs.append([pos, block, 1])
+                    pos += block_size
+                    weak = None
+                    continue
+            if pos + block_size == size or i + block_size == len(data):
+                break
+            out_byte, in_byte = data[i], data[i + block_size]
+            a = (a - out_byte + in_byte) % 65521
+            b = (b - block_size * out_byte + a - 1) % 65521
+            weak = a | b << 16
+            pos += 1
+    return [tuple(run) for run in runs]
+
+
+def apply_delta(source_path, path, runs, block_size):
+    """
+    Copy matched blocks of the local copy to their place in the new file
+    """
+    with open(source_path, 'rb') as src, open(path, 'wb') as dst:
+        for offset, block, count in runs:
+            src.seek(block * block_size)
+            dst.seek(offset)
+            left = count * block_size
+            while left > 0:
+                data = src.read(min(left, 256 * block_size))
+                dst.write(data)
+                left -= len(data)
+
+
+def covered_chunks(runs, block_size, size, mtime, chunk_size):
+    """
+    Bitmap of chunks entirely covered by copied blocks
+    """
+    bitmap = ChunkBitmap(size, mtime, chunk_size)
+    intervals = []
+    for offset, block, count in sorted(runs):
+        end = offset + count * block_size
+        if intervals and offset <= intervals[-1][1]:
+            intervals[-1][1] = max(intervals[-1][1], end)
+        else:
+            intervals.append([offset, end])
+    for start, end in intervals:
+        last = bitmap.chunks_count if end >= size else end // chunk_size
+        for index in range(-(-start // chunk_size), last):
+            bitmap.set(index)
+    return bitmap
+
+
+class FileWriter:
+    """
+    Writes chunks of a download on a dedicated thread: the file is preallocated,
+    queued adjacent chunks are coalesced into one pwritev, chunks are marked
+    in `bitmap` once written, fsync only when the download is finished.
+    The file digest is updated as the contiguous part grows. Chunks above a
+    gap are kept for it up to MAX_UNHASHED bytes, chunks on disk but not kept
+    (written before a resume or past the limit) are read back once the gap fills
+    """
+
+    QUEUE_SIZE = 256  # chunks, more are dropped for the server to resend
+    MAX_BATCH = 64
+    MAX_UNHASHED = 512 * 1024
+
+    def __init__(self, path, size, bitmap, truncate=True):
+        self.path = path
+        self.size = size
+        self.bitmap = bitmap
+        self.digest = hashlib.blake2b(digest_size=TransferCompleteMessage.DIGEST_SIZE)
+        self.hashed = 0  # file offset the digest covers
+        self.unhashed = {}  # offset -> data written above the hashed offset
+        self.unhashed_size = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | (os.O_TRUNC if truncate else 0), 0o644)
+        try:
+            if size and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fd, 0, size)
+            else:
+                os.ftruncate(self.fd, size)
+        except OSError:
+            os.ftruncate(self.fd, size)
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='writer {}'.format(path), daemon=True)
+        self.thread.start()
+
+    def write(self, index, offset, data):
+        """
+        Queue the chunk, False when the queue is full and it was not queued
+        """
+        if self.error is not None:
+            raise self.error
+        try:
+            self.queue.put_nowait((offset, index, data))
+        except queue.Full:
+            return False
+        return True
+
+    def finish(self, sync=True):
+        """
+        Write all queued chunks and close the file, blocks until done,
+        returns the file digest, None if some chunks are missing
+        """
+        self.queue.put(sync)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.hashed < self.size:
+            return None
+        return self.digest.digest()
+
+    def run(self):
+        stop = None
+        try:
+            while stop is None:
+                batch = []
+                item = self.queue.get()
+                while True:
+                    if isinstance(item, bool):
+                        stop = item
+                    else:
+                        batch.append(item)
+                    if len(batch) >= self.MAX_BATCH:
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                self.write_batch(batch)
+                self.update_digest(batch)
+            if stop:
+                os.fsync(self.fd)
+        except OSError as e:
+            logger.error("Write to %s failed: %s", self.path, e)
+            self.error = e
+            # unblock the receiver, chunks are dropped
+            while stop is None:
+                item = self.queue.get()
+                if isinstance(item, bool):
+                    stop = item
+        finally:
+            os.close(self.fd)
+
+    def write_batch(self, batch):
+        batch.sort(key=lambda item: item[0])
+        start = 0
+        for i in range(1, len(batch) + 1):
+            if i == len(batch) or batch[i - 1][0] + len(batch[i - 1][2]) != batch[i][0]:
+                self.pwritev(batch[start][0], [data for _, _, data in batch[start:i]])
+                for _, index, _ in batch[start:i]:
+                    self.bitmap.set(index)
+                start = i
+
+    def update_digest(self, batch):
+        for offset, _, data in batch:
+            if offset == self.hashed or (offset > self.hashed and offset not in self.unhashed
+                                         and self.unhashed_size + len(data) <= self.MAX_UNHASHED):
+                self.unhashed[offset] = data
+                self.unhashed_size += len(data)
+        chunk_size = self.bitmap.chunk_size
+        while self.hashed < self.size:
+            data = self.unhashed.pop(self.hashed, None)
+            if data is not None:
+                self.unhashed_size -= len(data)
+            elif self.hashed // chunk_size in self.bitmap:
+                data = os.pread(self.fd, min(chunk_size, self.size - self.hashed), self.hashed)
             else:
                 break
-        logger.debug('Chunk sent: %s, %s', sequence, offset)
-        del self.ack_events[sequence]
+            self.digest.update(data)
+            self.hashed += len(data)
 
-    async def send_and_wait_ack(self, msg):
-        ack_event = asyncio.Event()
-        self.ack_events[msg.header.sequence] = ack_event
-        while True:
-            logger.debug('Sending message %s until ack', msg)
-            self.send_message(msg)
-            self.send_message(msg)
-            try:
-                await asyncio.wait_for(ack_event.wait(), timeout=self.ACK_TIMEOUT)
-            except asyncio.TimeoutError:
-                continue
+    def pwritev(self, offset, buffers):
+        if hasattr(os, 'pwritev'):
+            written = os.pwritev(self.fd, buffers, offset)
+        else:
+            written = 0
+        data = b''.join(buffers) if written < sum(len(b) for b in buffers) else b''
+        while written < len(data):
+            written += os.pwrite(self.fd, data[written:], offset + written)
+
+
+class ReceivedChunks:
+    """
+    Chunks received in a session: one bit per chunk index and the cumulative
+    point all chunks below are in. `received` may start with the chunks already
+    on disk when a download is resumed
+    """
+
+    def __init__(self, received):
+        self.received = received  # ChunkBitmap
+        self.chunks_count = received.chunks_count
+        self.cumulative = 0
+        self.highest = -1
+        self.checked = 0  # chunks below are reported by lost_ranges already
+        self.advance()
+
+    def __contains__(self, index):
+        return index >= self.chunks_count or index in self.received
+
+    def add(self, index):
+        if index in self:
+            return False
+        self.received.set(index)
+        self.highest = max(self.highest, index)
+        if index == self.cumulative:
+            self.advance()
+        return True
+
+    def lost_ranges(self, reorder, max_ranges):
+        """
+        [start, end) ranges of chunks still missing with `reorder` or more
+        later chunks received, each chunk is reported once
+        """
+        end = self.highest - reorder + 1
+        start = max(self.checked, self.cumulative)
+        if end <= start:
+            return []
+        self.checked = end
+        ranges = []
+        first = None
+        for i in range(start, end):
+            if i in self.received:
+                if first is not None:
+                    ranges.append((first, i))
+                    first = None
+            elif first is None:
+                first = i
+        if first is not None:
+            ranges.append((first, end))
+        return ranges[:max_ranges]
+
+    def advance(self):
+        bits = self.received.bits
+        while self.cumulative < self.chunks_count:
+            byte = bits[self.cumulative >> 3]
+            if byte == 0xff and not self.cumulative & 7:
+                self.cumulative += 8
+            elif (byte >> (self.cumulative & 7)) & 1:
+                self.cumulative += 1
             else:
                 break
-        logger.debug('Message sent, ack received: %s', msg)
-        del self.ack_events[msg.header.sequence]
-            
-    # async def do_send_list_item(self, item):
-    #     ack_event = asyncio.Event()
-    #     sequence = self.next_sequence()
-    #     self.ack_events[sequence] = ack_event
-    #     while True:
-    #         self.send_message(msg)
-    #         try:
-    #             await asyncio.wait_for(ack_event.wait(), timeout=self.ACK_TIMEOUT)
-    #         except asyncio.TimeoutError:
-    #             continue
-    #         else:
-    #             break
-    #     del self.ack_event[sequence]
+
+    def bitmap(self, bits):
+        """
+        SACK bitmap: bit i is chunk cumulative + 1 + i
+        """
+        start = self.cumulative + 1
+        first = start >> 3
+        value = int.from_bytes(self.received.bits[first:first + bits // 8 + 1], 'little') >> (start & 7)
+        return (value & ((1 << bits) - 1)).to_bytes(bits // 8, 'little')
+
+    def missing_ranges(self, max_ranges):
+        """
+        [start, end) ranges of chunks not received yet, merged to fit max_ranges
+        """
+        return self.received.missing_ranges(max_ranges)
 
 
 class FtpClient(WFBNode):
 
     ACK_TIMEOUT = 0.05
-
-    def __init__(self, inport, outport):
-        super().__init__(inport, outport)
-        self.ack_events = {}
+    SACK_EVERY = 16  # chunks
+    NACK_REORDER = RadioLink.FEC_K  # later chunks before a skipped one is lost, wfb_rx delivers recovered ones late
+    SACK_INTERVAL = 0.01
+    BITMAP_SAVE_INTERVAL = 1.0
+    DELTA_MIN_BLOCK = 1024
+    LIST_PAGES = 16  # list datagrams per request
+    LINGER = 3  # seconds to ack a repeated TRANSFER_COMPLETE before a one shot client exits
+    STALE_TIMEOUT = 30  # seconds without chunks or FLUSH polls before a download is given up, server gives up after 10
+
+    def __init__(self, inport, outport, node_id=1, stats_port=None, batch_io=False, link=None):
+        super().__init__(inport, outport, stats_port, batch_io)
+        self.node_id = node_id  # tells ground stations apart in multicast sessions, 0 is the server
+        self.link = link or RadioLink()  # uplink the requests and NACKs are sized to
         self.requests_events = {}
-        self.file_handlers = {}
-        self.nack_events = {}
+        self.request_sessions = {}  # file request sequence -> session id
+        self.refused_sessions = set()
+        self.file_writers = {}
         self.transfer_complete_events = {}
+        self.transfer_digests = {}
+        self.received_chunks = {}
+        self.sack_pending = {}
+        self.sack_timers = {}
+        self.last_chunk_time = {}
+        self.last_heard = {}  # session id -> time of the last chunk, parity or FLUSH
+        self.parity_decoders = {}
+        self.part_paths = {}
+        self.resume_bitmaps = {}
+        self.chunk_bitmaps = {}
+        self.delta_sources = {}
+        self.delta_runs = {}
+        self.delta_tasks = {}
+        self.session_codecs = {}
+        self.list_pages = {}
+        self.list_events = {}
+        self.multicast_sessions = set()
+        self.transfer_stats = {}
+        self.receiving = False
+        self.announcements = asyncio.Queue()
 
     def handle_message(self, message):
-        if message.header.cmd == Command.SEND_CHUNK:
+        if message.header.cmd == Command.ACK:
+            if message.ack_sequence in self.ack_events:
+                self.ack_events[message.ack_sequence].set()
+            session_id = self.request_sessions.get(message.ack_sequence)
+            if not message.ack and session_id in self.requests_events:
+                # negative ack of a file request: no such file
+                self.refused_sessions.add(session_id)
+                self.requests_events[session_id].set()
+        elif message.header.cmd == Command.SEND_CHUNK:
             logger.debug("Receiced chunk: %s, %s", message.session_id, message.offset)
-            if message.session_id in self.requests_events:
-                self.requests_events[message.session_id].set()
-            
-            ack = AckMessage(self.next_sequence(), node_id=1, ack_sequence=message.header.sequence, ack=True)
-            if message.header.sequence in self.session_requests[message.session_id]:
-                # chunk processed, just send ack
-                logger.debug("Just ACK: %s, %s, %s", message.header.sequence, message.session_id, message.offset)
-                self.send_message(ack)
-                self.send_message(ack)
+            if message.session_id not in self.received_chunks:
+                return
+            stats = self.transfer_stats[message.session_id]
+            stats.chunks_received += 1
+
+            if message.index in self.received_chunks[message.session_id]:
+                # chunk stored already, the server missed our SACK - repeat it now
+                stats.duplicates += 1
+                if message.session_id not in self.multicast_sessions:
+                    stats.sacks_lost += 1
+                logger.debug("Just SACK: %s, %s, %s", message.header.sequence, message.session_id, message.index)
+                self.send_sack(message.session_id)
+                return
+
+            data = message.data
+            if message.flags & SendChunkMessage.COMPRESSED:
+                try:
+                    data = decompress_chunk(self.session_codecs[message.session_id], data)
+                except Exception as e:
+                    logger.info("Can't decompress chunk %s, %s: %s", message.session_id, message.index, e)
+                    return
+            if len(data) != message.size or zlib.crc32(data) != message.crc:
+                # dropped, SACK holes make the server send it again
+                stats.broken += 1
+                logger.info("Broken chunk %s, %s: size %s of %s", message.session_id, message.index,
+                            len(data), message.size)
                 return
 
-            if message.session_id in self.file_handlers:
-                logger.debug("Writing chunk: %s, %s", message.session_id, message.offset)
-                fd = self.file_handlers[message.session_id]
-                fd.seek(message.offset)
-                fd.write(message.data)
-                self.session_requests[message.session_id].add(message.header.sequence)
+            self.last_chunk_time[message.session_id] = self.last_heard[message.session_id] = time.monotonic()
+            stored = self.store_chunk(message.session_id, message.index, message.offset, data)
+            if message.session_id not in self.multicast_sessions and message.session_id not in self.parity_decoders:
+                self.send_nack(message.session_id)
+            decoder = self.parity_decoders.get(message.session_id)
+            if decoder is not None and stored:
+                self.store_recovered(message.session_id,
+                                     decoder.add_chunk(message.index, data, self.received_chunks[message.session_id]))
+            self.schedule_sack(message.session_id)
+        elif message.header.cmd == Command.FILE_INFO:
+            if message.session_id in self.requests_events and message.session_id not in self.chunk_bitmaps:
+                if message.session_id in self.delta_sources:
+                    # acked once local blocks are copied, chunks may not arrive before that
+                    if message.session_id not in self.delta_tasks:
+                        self.delta_tasks[message.session_id] = asyncio.create_task(self.open_delta_download(message))
+                    return
+                self.open_download(message)
+                self.requests_events[message.session_id].set()
+            ack = AckMessage(self.next_sequence(), node_id=self.node_id, ack_sequence=message.header.sequence, ack=True)
+            self.send_message(ack)
+            self.send_message(ack)
+        elif message.header.cmd == Command.ANNOUNCE:
+            if message.session_id not in self.multicast_sessions:
+                if not self.receiving:
+                    return
+                self.open_multicast_download(message)
+            ack = AckMessage(self.next_sequence(), node_id=self.node_id, ack_sequence=message.header.sequence, ack=True)
             self.send_message(ack)
+        elif message.header.cmd == Command.FLUSH:
+            if message.session_id in self.multicast_sessions:
+                self.last_heard[message.session_id] = time.monotonic()
+                ranges = self.received_chunks[message.session_id].missing_ranges(self.link.max_ranges(NackMessage))
+                nack = NackMessage(self.next_sequence(), node_id=self.node_id, session_id=message.session_id,
+                                   round=message.round, ranges=ranges)
+                self.send_message(nack)
+        elif message.header.cmd == Command.PROBE:
+            ack = AckMessage(self.next_sequence(), node_id=self.node_id, ack_sequence=message.header.sequence, ack=True)
             self.send_message(ack)
+        elif message.header.cmd == Command.LIST_PAGE:
+            if message.request_id in self.list_pages:
+                self.list_pages[message.request_id].append(message)
+                self.list_events[message.request_id].set()
+        elif message.header.cmd == Command.DELTA_MATCHES:
+            if message.session_id in self.delta_runs:
+                self.delta_runs[message.session_id][message.batch] = message.runs
+            ack = AckMessage(self.next_sequence(), node_id=self.node_id, ack_sequence=message.header.sequence, ack=True)
+            self.send_message(ack)
+        elif message.header.cmd == Command.PARITY:
+            decoder = self.parity_decoders.get(message.session_id)
+            received = self.received_chunks.get(message.session_id)
+            if decoder is not None and received is not None:
+                self.last_heard[message.session_id] = time.monotonic()
+                self.store_recovered(message.session_id, decoder.add_parity(message, received))
         elif message.header.cmd == Command.TRANSFER_COMPLETE:
             if message.session_id in self.transfer_complete_events:
+                self.transfer_digests[message.session_id] = message.digest
                 self.transfer_complete_events[message.session_id].set()
-            ack = AckMessage(self.next_sequence(), node_id=1, ack_sequence=message.header.sequence, ack=True)
+            timer = self.sack_timers.pop(message.session_id, None)
+            if timer is not None:
+                timer.cancel()
+            ack = AckMessage(self.next_sequence(), node_id=self.node_id, ack_sequence=message.header.sequence, ack=True)
             self.send_message(ack)
             self.send_message(ack)
 
-    async def get_file(self, name):
-        name = name.encode()
+    def open_download(self, info):
+        session_id = info.session_id
+        part_path = self.part_paths[session_id]
+        bitmap = self.resume_bitmaps.pop(session_id, None)
+        if bitmap is not None and info.resumed:
+            logger.info("Resuming %s: %s of %s chunks on disk", part_path,
+                        sum(1 for i in range(bitmap.chunks_count) if i in bitmap), bitmap.chunks_count)
+            self.received_chunks[session_id] = ReceivedChunks(bitmap.copy())
+            truncate = False
+        else:
+            bitmap = ChunkBitmap(info.size, info.mtime, info.chunk_size)
+            self.received_chunks[session_id] = ReceivedChunks(ChunkBitmap(info.size, info.mtime, info.chunk_size))
+            truncate = True
+        self.file_writers[session_id] = FileWriter(part_path, info.size, bitmap, truncate=truncate)
+        self.chunk_bitmaps[session_id] = bitmap
+        self.session_codecs[session_id] = info.codec
+        stats = self.transfer_stats[session_id] = TransferStats(session_id, os.path.basename(part_path[:-5]),
+                                                                'receive', info.size)
+        self.metrics.add(stats)
+
+    def open_multicast_download(self, announce):
+        session_id = announce.session_id
+        name = os.path.basename(announce.name.decode().strip('\x00'))
+        logger.info("Joining multicast %s of %s", session_id, name)
+        self.multicast_sessions.add(session_id)
+        self.part_paths[session_id] = name + '.part'
+        if 0 < announce.fec_m <= announce.fec_k:
+            self.parity_decoders[session_id] = ParityDecoder(announce.fec_k, announce.fec_m)
+        self.transfer_complete_events[session_id] = asyncio.Event()
+        self.open_download(announce)
+        self.announcements.put_nowait((session_id, name))
+
+    async def open_delta_download(self, info):
+        session_id = info.session_id
+        source_path, block_size = self.delta_sources[session_id]
+        batches = self.delta_runs[session_id]
+        runs = [run for batch in sorted(batches) for run in batches[batch]]
+        if info.resumed:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, apply_delta, source_path, self.part_paths[session_id], runs, block_size)
+            self.resume_bitmaps[session_id] = covered_chunks(runs, block_size, info.size, info.mtime, info.chunk_size)
+            logger.info("Delta of %s: %s copy runs", source_path, len(runs))
+        self.open_download(info)
+        self.requests_events[session_id].set()
+        ack = AckMessage(self.next_sequence(), node_id=self.node_id, ack_sequence=info.header.sequence, ack=True)
+        self.send_message(ack)
+        self.send_message(ack)
+
+    async def send_signatures(self, session_id, path):
+        """
+        Signatures of the local copy for a delta transfer, returns (block_size, blocks_count)
+        """
+        block_size = max(self.DELTA_MIN_BLOCK, math.isqrt(os.path.getsize(path)))
+        loop = asyncio.get_running_loop()
+        signatures = await loop.run_in_executor(None, block_signatures, path, block_size)
+        rtt = RttEstimator(self.ACK_TIMEOUT)
+        max_signatures = self.link.max_signatures()
+        for first in range(0, len(signatures), max_signatures):
+            msg = SignaturesMessage(self.next_sequence(), node_id=self.node_id, session_id=session_id, first_block=first,
+                                    signatures=signatures[first:first + max_signatures])
+            await self.send_and_wait_ack(msg, rtt)
+        return block_size, len(signatures)
+
+    def save_bitmap(self, session_id):
+        # bits are set by the writer thread once a chunk is on disk
+        if session_id in self.chunk_bitmaps:
+            self.chunk_bitmaps[session_id].save(self.part_paths[session_id] + '.bitmap')
+
+    def store_chunk(self, session_id, index, offset, data):
+        """
+        False when the chunk is a duplicate or the writer is behind: a dropped
+        chunk is left missing, SACK holes and NACKs make the server resend it
+        """
+        received = self.received_chunks[session_id]
+        stats = self.transfer_stats[session_id]
+        if index in received:
+            stats.duplicates += 1
+            return False
+        writer = self.file_writers.get(session_id)
+        if writer is not None:
+            logger.debug("Writing chunk: %s, %s", session_id, offset)
+            if not writer.write(index, offset, data):
+                logger.debug("Writer queue full, chunk dropped: %s, %s", session_id, index)
+                stats.dropped += 1
+                return False
+        received.add(index)
+        stats.bytes += len(data)
+        return True
+
+    def store_recovered(self, session_id, recovered):
+        self.transfer_stats[session_id].recovered += len(recovered)
+        for index, offset, data in recovered:
+            logger.debug("Chunk recovered from parity: %s, %s", session_id, index)
+            self.store_chunk(session_id, index, offset, data)
+        if recovered:
+            self.schedule_sack(session_id)
+
+    def send_nack(self, session_id):
+        """
+        Ask for the chunks skipped in the stream right away, not after the sender timeout
+        """
+        ranges = self.received_chunks[session_id].lost_ranges(self.NACK_REORDER, self.link.max_ranges(NackMessage))
+        if not ranges:
+            return
+        self.transfer_stats[session_id].nacks_sent += 1
+        logger.debug("Gap NACK: %s, %s", session_id, ranges)
+        msg = NackMessage(self.next_sequence(), node_id=self.node_id, session_id=session_id, round=0, ranges=ranges)
+        self.send_message(msg)
+
+    def schedule_sack(self, session_id):
+        if session_id in self.multicast_sessions:
+            # multicast receivers only answer FLUSH polls
+            return
+        self.sack_pending[session_id] = self.sack_pending.get(session_id, 0) + 1
+        if self.sack_pending[session_id] >= self.SACK_EVERY:
+            self.send_sack(session_id)
+        elif session_id not in self.sack_timers:
+            loop = asyncio.get_running_loop()
+            self.sack_timers[session_id] = loop.call_later(self.SACK_INTERVAL, self.send_sack, session_id)
+
+    def send_sack(self, session_id):
+        if session_id in self.multicast_sessions:
+            return
+        self.transfer_stats[session_id].sacks_sent += 1
+        timer = self.sack_timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+        self.sack_pending[session_id] = 0
+        received = self.received_chunks[session_id]
+        delay = time.monotonic() - self.last_chunk_time.get(session_id, time.monotonic())
+        msg = SackMessage(self.next_sequence(), node_id=self.node_id, session_id=session_id, cumulative=received.cumulative,
+                          delay=min(int(delay / SackMessage.DELAY_UNIT), 0xffff),
+                          bitmap=received.bitmap(SackMessage.BITMAP_BITS))
+        self.send_message(msg)
+
+    async def get_file(self, name, fec_k=0, fec_m=0, resume=True, delta=False, codec=Codec.NONE,
+                       priority=0, weight=1, session_id=None, linger=LINGER):
+        """
+        Download `name` to the current dir, `priority` and `weight` place the
+        transfer against other server sessions: higher priority goes first,
+        equal priorities share the link in proportion to weight. `linger`
+        seconds after the download the node stays up to ack a repeated
+        TRANSFER_COMPLETE, long running clients pass 0.
+        Returns the transfer time in seconds, FileNotFoundError when the
+        server has no such file
+        """
         logger.info("Getting file %s...", name)
-        asyncio.create_task(self.start())  # FIXME!!!!
-        await asyncio.sleep(0.5)
+        if not Codec.available(codec):
+            logger.info("Compression codec %s is not available, downloading uncompressed", codec)
+            codec = Codec.NONE
+        await self.listen()
         start_time = time.monotonic()
         sequence = self.next_sequence()
-        session_id = self.next_session()
-        msg = GetFileMessage(sequence, node_id=1, session_id=session_id, name=name)
+        if session_id is None:
+            session_id = self.next_session()
+        part_path = name + '.part'
+        bitmap_path = part_path + '.bitmap'
+        bitmap = None
+        if resume and os.path.exists(part_path) and os.path.exists(bitmap_path):
+            try:
+                bitmap = ChunkBitmap.load(bitmap_path)
+            except (OSError, ValueError, struct.error) as e:
+                logger.info("Can't resume %s: %s", name, e)
+        if bitmap is not None:
+            msg = ResumeFileMessage(sequence, node_id=self.node_id, session_id=session_id, name=name.encode(),
+                                    fec_k=fec_k, fec_m=fec_m, codec=codec, priority=priority, weight=weight,
+                                    size=bitmap.size, mtime=bitmap.mtime,
+                                    chunk_size=bitmap.chunk_size,
+                                    ranges=bitmap.missing_ranges(self.link.max_ranges(ResumeFileMessage)))
+            self.resume_bitmaps[session_id] = bitmap
+        elif delta and os.path.isfile(name) and os.path.getsize(name) >= self.DELTA_MIN_BLOCK:
+            block_size, blocks_count = await self.send_signatures(session_id, name)
+            msg = DeltaFileMessage(sequence, node_id=self.node_id, session_id=session_id, name=name.encode(),
+                                   fec_k=fec_k, fec_m=fec_m, codec=codec, priority=priority, weight=weight,
+                                   block_size=block_size, blocks_count=blocks_count)
+            self.delta_sources[session_id] = (name, block_size)
+            self.delta_runs[session_id] = {}
+        else:
+            msg = GetFileMessage(sequence, node_id=self.node_id, session_id=session_id, name=name.encode(),
+                                 fec_k=fec_k, fec_m=fec_m, codec=codec, priority=priority, weight=weight)
         event = asyncio.Event()
         self.requests_events[session_id] = event
-        self.session_requests[session_id] = set()
-        self.file_handlers[session_id] = open(name, 'wb')
+        self.request_sessions[sequence] = session_id
+        self.part_paths[session_id] = part_path
+        if 0 < fec_m <= fec_k:
+            self.parity_decoders[session_id] = ParityDecoder(fec_k, fec_m)
         self.transfer_complete_events[session_id] = asyncio.Event()
-        while not event.is_set():
-            self.send_message(msg)
-            await asyncio.sleep(0.05)
+        rtt = RttEstimator(self.ACK_TIMEOUT)
+        try:
+            while not event.is_set():
+                self.send_message(msg)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=rtt.rto)
+                except asyncio.TimeoutError:
+                    rtt.backoff()
+        except BaseException:
+            self.close_session(session_id)
+            raise
+        finally:
+            del self.requests_events[session_id]
+            del self.request_sessions[sequence]
+            self.delta_sources.pop(session_id, None)
+            self.delta_runs.pop(session_id, None)
+            self.delta_tasks.pop(session_id, None)
+        if session_id in self.refused_sessions:
+            self.refused_sessions.discard(session_id)
+            self.close_session(session_id)
+            raise FileNotFoundError('No file {} on the server'.format(name))
         logger.info("Session confirmed: %s, %s", session_id, name)
-        del self.requests_events[session_id]
 
-        await self.transfer_complete_events[session_id].wait()
+        try:
+            transfer_time = await self.finish_download(session_id, name, start_time)
+        finally:
+            self.close_session(session_id)
+        await asyncio.sleep(linger)
+        return transfer_time
+
+    def close_session(self, session_id):
+        """
+        Free the state of a finished or abandoned download, chunks arriving
+        late are dropped since the session is unknown then
+        """
+        writer = self.file_writers.pop(session_id, None)
+        if writer is not None and writer.thread.is_alive():
+            writer.finish(sync=False)
+        timer = self.sack_timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+        for state in (self.received_chunks, self.sack_pending, self.last_chunk_time, self.last_heard,
+                      self.parity_decoders, self.part_paths, self.resume_bitmaps, self.chunk_bitmaps, self.session_codecs,
+                      self.transfer_stats, self.transfer_digests, self.transfer_complete_events):
+            state.pop(session_id, None)
+        self.multicast_sessions.discard(session_id)
+
+    async def finish_download(self, session_id, name, start_time):
+        """
+        Wait for TRANSFER_COMPLETE, check the file digest and move the download
+        in place, returns the time since start_time
+        """
+        part_path = self.part_paths[session_id]
+        bitmap_path = part_path + '.bitmap'
+        complete_event = self.transfer_complete_events[session_id]
+        wait_start = time.monotonic()
+        try:
+            while not complete_event.is_set():
+                try:
+                    await asyncio.wait_for(complete_event.wait(), timeout=self.BITMAP_SAVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    self.save_bitmap(session_id)
+                    if time.monotonic() - self.last_heard.get(session_id, wait_start) > self.STALE_TIMEOUT:
+                        logger.error("File %s stalled, no data for %s s", name, self.STALE_TIMEOUT)
+                        raise TimeoutError('File {} stalled, no data for {} s'.format(name, self.STALE_TIMEOUT))
+        except BaseException:
+            writer = self.file_writers.get(session_id)
+            if writer is not None:
+                writer.finish(sync=False)
+            self.save_bitmap(session_id)
+            if session_id in self.transfer_stats:
+                self.metrics.finish(self.transfer_stats[session_id])
+            raise
         del self.transfer_complete_events[session_id]
+        self.metrics.finish(self.transfer_stats[session_id])
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self.file_writers[session_id].finish)
+        if digest != self.transfer_digests.pop(session_id):
+            logger.error("File %s digest mismatch, download discarded", name)
+            os.remove(part_path)
+            if os.path.exists(bitmap_path):
+                os.remove(bitmap_path)
+            raise ValueError('File {} digest mismatch'.format(name))
+        os.replace(part_path, name)
+        if os.path.exists(bitmap_path):
+            os.remove(bitmap_path)
         transfer_time = time.monotonic() - start_time
         logger.info("File %s received is %ss", name, transfer_time)
-        await asyncio.sleep(3) # give time to send last ACK
-
-
-    async def get_list(self):
-        pass
+        return transfer_time
+
+    async def receive_files(self, count=None):
+        """
+        Join multicast sessions the server pushes and save their files to the
+        current dir, returns the names after `count` files, never without it
+        """
+        await self.listen()
+        self.receiving = True
+        names = []
+        try:
+            while count is None or len(names) < count:
+                session_id, name = await self.announcements.get()
+                start_time = time.monotonic()
+                try:
+                    await self.finish_download(session_id, name, start_time)
+                except (ValueError, TimeoutError) as e:
+                    logger.error("Multicast %s failed: %s", session_id, e)
+                    continue
+                finally:
+                    self.close_session(session_id)
+                names.append(name)
+        finally:
+            self.receiving = False
+        await asyncio.sleep(1)  # give time to send last ACK
+        return names
+
+
+    async def get_list(self, hashes=False):
+        """
+        Server directory listing: [(name, size, mtime, digest)], digest is None without `hashes`
+        """
+        await self.listen()
+        request_id = self.next_session()
+        flags = GetListMessage.HASHES if hashes else 0
+        pages = self.list_pages[request_id] = collections.deque()
+        event = self.list_events[request_id] = asyncio.Event()
+        entries = {}
+        generation = 0
+        total = None
+        rtt = RttEstimator(self.ACK_TIMEOUT)
+        try:
+            while total is None or len(entries) < total:
+                first = next(index for index in itertools.count() if index not in entries)
+                msg = GetListMessage(self.next_sequence(), node_id=self.node_id, request_id=request_id, first=first,
+                                     pages=self.LIST_PAGES, flags=flags)
+                self.send_message(msg)
+                sent_at = time.monotonic()
+                last = False
+                while not last:
+                    if not pages:
+                        event.clear()
+                        try:
+                            await asyncio.wait_for(event.wait(), timeout=rtt.rto)
+                        except asyncio.TimeoutError:
+                            rtt.backoff()
+                            break
+                    page = pages.popleft()
+                    if page.generation < generation:
+                        continue
+                    if page.generation > generation:
+                        # directory changed, start over
+                        generation = page.generation
+                        entries.clear()
+                    if page.first == first and sent_at is not None:
+                        rtt.sample(time.monotonic() - sent_at)
+                        sent_at = None
+                    total = page.total
+                    for index, (name, size, mtime, digest) in enumerate(page.entries, page.first):
+                        entries[index] = (name.decode(errors='replace'), size, mtime, digest)
+                    last = page.last
+        finally:
+            del self.list_pages[request_id]
+            del self.list_events[request_id]
+        logger.info("Listed %s files", total)
+        return [entries[index] for index in range(total)]
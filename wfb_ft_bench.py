@@ -0,0 +1,71 @@
+"""
+Wire protocol microbenchmark: messages/sec of wfb_ft message decoding and
+encoding, the legacy path (format strings, sliced copies, **fields init)
+against the precompiled packers
+"""
+
+import argparse
+import os
+import struct
+import time
+
+from wfb_ft import AckMessage, SackMessage, SendChunkMessage, WFBNode, messages
+
+
+def legacy_unpack(cls, data):
+    header_cmd, version, node_id, sequence = struct.unpack('>BBHI', data[:8])
+    fixed_size = struct.calcsize(cls.struct_format)
+    fields_values = struct.unpack(cls.struct_format, data[8:8 + fixed_size])
+    fields = dict(zip(cls.fields, fields_values))
+    if cls.variable:
+        fields[cls.fields[-1]] = data[8 + fixed_size:]
+    return cls(sequence, node_id, **fields)
+
+
+def legacy_pack(msg):
+    header = msg.header
+    data = struct.pack('>BBHI', header.cmd, header.version, header.node_id, header.sequence)
+    values = msg.fields_list()
+    if msg.variable:
+        return data + struct.pack(msg.struct_format, *values[:-1]) + values[-1]
+    return data + struct.pack(msg.struct_format, *values)
+
+
+def decode(data):
+    return messages[data[0]].unpack(memoryview(data))
+
+
+def sample_messages():
+    return [
+        SendChunkMessage(1000, node_id=0, session_id=12345, index=10, offset=12240, size=1224, flags=0,
+                         crc=0, data=os.urandom(1224)),
+        SackMessage(1001, node_id=1, session_id=12345, cumulative=10, delay=5, bitmap=os.urandom(32)),
+        AckMessage(1002, node_id=1, ack_sequence=1000, ack=True),
+    ]
+
+
+def rate(func, arg, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        func(arg)
+    return count / (time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WFB FT wire protocol microbenchmark')
+    parser.add_argument('--count', type=int, default=200000, help='Messages per measurement')
+    args = parser.parse_args()
+
+    buffer = bytearray(WFBNode.DATAGRAM_BUFFER_SIZE)
+    print('{:<20} {:>14} {:>14} {:>14} {:>14}'.format('message', 'decode before', 'decode after',
+                                                       'encode before', 'encode after'))
+    for msg in sample_messages():
+        data = msg.pack()
+        assert legacy_pack(msg) == data and bytes(msg.pack_into(buffer)) == data
+        assert legacy_unpack(type(msg), data).fields_list() == decode(data).fields_list()
+        print('{:<20} {:>14,.0f} {:>14,.0f} {:>14,.0f} {:>14,.0f}'.format(
+            type(msg).__name__,
+            rate(lambda d: legacy_unpack(messages[d[0]], d), data, args.count),
+            rate(decode, data, args.count),
+            rate(legacy_pack, msg, args.count),
+            rate(msg.pack_into, buffer, args.count)))
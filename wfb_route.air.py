@@ -5,6 +5,8 @@ import sys
 import struct
 import time
 
+import udp_batch
+
 # import uvloop
 
 #from pymavlink.dialects.v20 import common
@@ -44,33 +46,33 @@ class UDPProxyProtocol:
         print("Error received:", self.ra, exc)
 
 
-async def main(inport, outport, listen, connect):   
+async def main(inport, outport, listen, connect, batch_io=False):   
     print("Starting WFB UDP router")
 
     # Get a reference to the event loop as we plan to use
     # low-level APIs.   
     loop = asyncio.get_running_loop()
 
-    _, output_proto = await loop.create_datagram_endpoint(
+    _, output_proto = await udp_batch.create_datagram_endpoint(
         lambda: UDPProxyProtocol(None),
-        remote_addr=('127.0.0.1', outport))
+        remote_addr=('127.0.0.1', outport), batched=batch_io)
 
     if connect:
-        _, proto = await loop.create_datagram_endpoint(
+        _, proto = await udp_batch.create_datagram_endpoint(
             lambda: UDPProxyProtocol(output_proto),
-            remote_addr=('127.0.0.1', connect))
+            remote_addr=('127.0.0.1', connect), batched=batch_io)
 
     elif listen:
-        _, proto = await loop.create_datagram_endpoint(
+        _, proto = await udp_batch.create_datagram_endpoint(
             lambda: UDPProxyProtocol(output_proto),
-            local_addr=('127.0.0.1', listen))
+            local_addr=('127.0.0.1', listen), batched=batch_io)
     else:
         print("connect or listen required")
         exit(1)
 
-    _, input_proto = await loop.create_datagram_endpoint(
+    _, input_proto = await udp_batch.create_datagram_endpoint(
         lambda: UDPProxyProtocol(proto),
-        local_addr=('127.0.0.1', inport))
+        local_addr=('127.0.0.1', inport), batched=batch_io)
 
 
     # asyncio.ensure_future(report(loop, gs_proto, downlink_proto, status_proto, gs_link))
@@ -85,6 +87,7 @@ if __name__ == '__main__':
     parser.add_argument('--outport', type=int, required=True, help='WFB UDP out port')
     parser.add_argument('--listen', type=int, default=0, help='UDP port to listen')
     parser.add_argument('--connect', type=int, default=0, help='UDP port to connect')
+    parser.add_argument('--batch-io', action='store_true', help='Batch UDP syscalls with sendmmsg/recvmmsg (Linux)')
 
 
     args = parser.parse_args()
@@ -96,6 +99,7 @@ if __name__ == '__main__':
         outport=args.outport,
         listen=args.listen,
         connect=args.connect,
+        batch_io=args.batch_io,
     )
 
     asyncio.run(main_coro)